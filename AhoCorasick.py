@@ -0,0 +1,59 @@
+import re
+
+
+class AhoCorasick:
+    'aho-corasick automaton finding every occurrence of a set of words in a single pass over the code text, used by'
+    'PatternSet to find the literals its rules require without searching for each of them separately'
+    def __init__(self, words):
+        self.words = tuple(words)
+        # the trie of the words, node 0 is the root. for every node its children by character, the node its
+        # longest proper suffix leads to, and the indices of the words ending at it
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [()]
+        for word_index, word in enumerate(self.words):
+            node = 0
+            for char in word:
+                if char not in self.goto[node]:
+                    self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append(())
+                node = self.goto[node][char]
+            self.outputs[node] += (word_index,)
+        # breadth first, so the fail link of a node's parent is known before the node's
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail != 0 and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.outputs[child] += self.outputs[self.fail[child]]
+                queue.append(child)
+        # from the root the scan jumps straight to the next character a word begins with
+        first_chars = "".join(re.escape(char) for char in self.goto[0])
+        self.first_char = re.compile("[" + first_chars + "]") if len(first_chars) > 0 else None
+
+    # for every word the sorted offsets into text where it occurs
+    def find_all(self, text):
+        occurrences = [[] for _ in self.words]
+        if self.first_char is None:
+            return occurrences
+        goto, fail, outputs, words = self.goto, self.fail, self.outputs, self.words
+        node = 0
+        offset = 0
+        while offset < len(text):
+            if node == 0:
+                first = self.first_char.search(text, offset)
+                if first is None:
+                    break
+                offset = first.start()
+            char = text[offset]
+            while node != 0 and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            offset += 1
+            for word_index in outputs[node]:
+                occurrences[word_index].append(offset - len(words[word_index]))
+        return occurrences
@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 
 import numpy as np
 import pandas as pd
@@ -11,7 +12,7 @@ import statistics as st
 
 
 import GrammarGrep
-from GrammarAutomata import GrammarAutomata
+import RegExParser
 
 
 def match_regex_regular(regex: str, codelines: list):
@@ -20,8 +21,7 @@ def match_regex_regular(regex: str, codelines: list):
 
 def match_regex_context(regex: str, codelines: list):
     gg = GrammarGrep.GrammarGrep(codelines)
-    codelines_length = [len(s) for s in codelines]
-    return [GrammarAutomata.flattened_range(r, codelines_length) for r in gg.match(regex)]
+    return [(gg.code_text.offset(begin), gg.code_text.offset(end)) for begin, end in gg.match(regex)]
 
 
 def replace_regex_regular(regex: str, codelines: list, s: str):
@@ -42,6 +42,35 @@ def timereps(reps, func):
     return (end - start) / reps
 
 
+# match time of every engine, each chosen engine finds the spans itself. None is the default, spans by the lazy dfa
+def benchmark_engines(itercount, regexes, engines=("backtrack", "pike", "unanchored", "compiled", "dfa", None)):
+    res = defaultdict(list)
+    for benchmark_name in os.listdir("benchmarks"):
+        with open(os.path.join("benchmarks", benchmark_name)) as f:
+            gg = GrammarGrep.GrammarGrep(f.read())
+        for regex in regexes:
+            times = []
+            for engine in engines:
+                t = timereps(itercount, lambda: gg.match(regex, engine))
+                res[(engine, regex)].append(t)
+                times.append("{}: {}".format(engine, t))
+            print("benchmark: {}, regex: {}, {}".format(benchmark_name, regex, " ".join(times)))
+    return res
+
+
+# compile time of generated patterns of growing size, building the automata should grow linearly with the pattern
+def benchmark_compile(itercount, sizes=(100, 200, 400, 800)):
+    res = defaultdict(list)
+    pieces = {"concat": lambda i: "a;id", "stars": lambda i: "ab;*", "alternation": lambda i: ";|w{}".format(i)}
+    for name, piece in pieces.items():
+        for size in sizes:
+            regex = "".join(piece(i) for i in range(size)).lstrip(";|")
+            t = timereps(itercount, lambda: RegExParser.regex_to_nfa(regex))
+            res[name].append(t)
+            print("pattern: {}, size: {}, compile time: {}".format(name, size, t))
+    return res
+
+
 def benchmark_graph_plot(data):
     # set width of bar
     barWidth = 0.1
@@ -86,6 +115,12 @@ if __name__ == '__main__':
     itercount = 16
     regexes_regular = ["test", "str|int|arg(1*)", "[-]?[0-9]+", "def [a-zA-Z0-9]*\([[a-zA-Z0-9]*\):"]
     regexes_context = ["test", "str;|int;|arg;(1*;)", ";num", "def ;id(;id):"]
+    if len(sys.argv) > 1 and sys.argv[1] == "engines":
+        benchmark_engines(itercount, regexes_context)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "compile":
+        benchmark_compile(itercount)
+        sys.exit(0)
     res = defaultdict(list)
     for regex_context, regex_regular in zip(regexes_context, regexes_regular):
         for benchmark_name in os.listdir("benchmarks"):
@@ -0,0 +1,71 @@
+from bisect import bisect_right
+
+
+class CodeText:
+    'the code lines joined by newlines into a single text. the matching engines and the label index work on integer'
+    'offsets into the text, (lineno, col_offset) positions are only made from them, by bisecting the line starts,'
+    'when matches are handed back'
+    def __init__(self, codelines):
+        self.lines = codelines
+        self.text = "\n".join(codelines)
+        # the offset of the first character of every line
+        self.line_starts = []
+        offset = 0
+        for line in codelines:
+            self.line_starts.append(offset)
+            offset += len(line) + 1
+
+    @staticmethod
+    def of(code):
+        return code if isinstance(code, CodeText) else CodeText(code)
+
+    def __len__(self):
+        return len(self.text)
+
+    def offset(self, position):
+        lineno, col_offset = position
+        return self.line_starts[lineno] + col_offset
+
+    # the offset of a position whose column counts utf-8 bytes, as the ast module gives them
+    def byte_offset(self, position):
+        lineno, col_offset = position
+        line = self.lines[lineno]
+        if not line.isascii():
+            col_offset = len(line.encode()[:col_offset].decode())
+        return self.line_starts[lineno] + col_offset
+
+    def position(self, offset):
+        lineno = bisect_right(self.line_starts, offset) - 1
+        return lineno, offset - self.line_starts[lineno]
+
+    # the position range of an offset range, the end is searched for from the line of the begin
+    def range(self, offset_range):
+        begin, end = offset_range
+        line_starts = self.line_starts
+        lineno_begin = bisect_right(line_starts, begin) - 1
+        lineno_end = bisect_right(line_starts, end, lineno_begin) - 1
+        return (lineno_begin, begin - line_starts[lineno_begin]), (lineno_end, end - line_starts[lineno_end])
+
+    # groups with offset ranges turned into groups with position ranges
+    def ranges(self, groups):
+        return {group_index: [self.range(group_range) for group_range in group_ranges]
+                for group_index, group_ranges in groups.items()}
+
+    # the begin position tried after offset, or -1 past the last one. a match may begin at every character of a line
+    # and at the start of an empty line, but not at the end of a line that is not empty
+    def next_begin(self, offset):
+        text = self.text
+        offset += 1
+        if offset < len(text):
+            if text[offset] != "\n" or text[offset - 1] == "\n":
+                return offset
+            offset += 1
+            if offset < len(text):
+                return offset
+        # past the last character only the start of an empty last line is a begin
+        return offset if offset == len(text) and text[offset - 1] == "\n" else -1
+
+    # whether offset is the end of a line that is not empty, offsets past the text are not
+    def is_line_end(self, offset):
+        text = self.text
+        return 0 < offset <= len(text) and text[offset - 1] != "\n" and (offset == len(text) or text[offset] == "\n")
@@ -1,223 +1,1165 @@
 # import graphviz
 
 import os
+import re
+import threading
+from bisect import bisect_left
+from heapq import heappush, heappop
+from itertools import groupby
+
+from CodeText import CodeText
+from LabelIndex import LABEL_TYPES, LABEL_CODES, NO_ENDS
 
 #import graphviz
 
 os.environ["PATH"] += os.pathsep + 'C:/Program Files/Graphviz/bin'
 
+# characters ordered from the most to the least common in python code, used to pick the rarest literal to search for
+COMMON_CHARACTERS = " etaisnorlcdpu_fm.()h=g,b'y\"v:w[]k0x1TSE-AR2NIC+D#OLPF*3M"
+
+# edge kinds, a label edge's kind is its LabelIndex type code so it is also the index into the index's end tuples
+KIND_STR = len(LABEL_TYPES)
+KIND_EPSILON = KIND_STR + 1
+KIND_TRIE = KIND_EPSILON + 1
+# key of a trie node marking that a word ends at the node, mapped to the word's index in the alternation
+TRIE_END = ""
+# automatas with more closure edges than this are not turned into python source, see compiled_match_at
+CODEGEN_EDGES_MAX = 4000
+# the most states a LazyDFA caches before it is flushed, and the id standing for the state without items
+DFA_STATES_MAX = 10000
+DFA_DEAD = -1
+ENGINES = ("backtrack", "pike", "unanchored", "compiled", "dfa")
+# the captures of a thread that set no tag yet, see apply_tags
+NO_CAPTURES = None
+
 
 class GrammarAutomata:
-    class Group:
-        def __init__(self, lineno, col_offset):
-            self.lineno_begin = lineno
-            self.lineno_end = float('-inf')
-            self.col_offset_begin = col_offset
-            self.col_offset_end = float('-inf')
-
-    class Node:
-        def __init__(self):
-            self.edges = []
-
-        def add_edge(self, node_dst, cond):
-            self.edges.append((node_dst, cond))
-
-    class Cond:
-        # types are str, type_id, type_stmt, type_expr, type_str, type_num, epsilon
-        def __init__(self, type, str=""):
-            self.type = type
-            self.str = str
-
-        # returns if satisfied and index after passing
-        def check(self, codelines, labels: dict, lineno, col_offset):
-            if self.type == "str":
-                return codelines[lineno].startswith(self.str, col_offset), [(lineno, col_offset + len(self.str))]
-            elif self.type == "epsilon":
-                return True, [(lineno, col_offset)]
-            else:
-                matchs = []
-                if (lineno, col_offset) in labels:
-                    list_types = labels[(lineno, col_offset)]
-                    for (type, end_lineno, end_col_offset) in list_types:
-                        if type == self.type:
-                            matchs.append((end_lineno, end_col_offset))
-                if len(matchs) > 0:
-                    return True, matchs
-                else:
-                    return False, []
+    # states are integers, state 0 is the first and the last one is the accepting one (a pattern set's automata has
+    # a first and an accepting state per rule, see finish_set). edges are indices into parallel arrays holding the
+    # destination state, the kind and, for str edges, the index of the literal (for trie edges, the index of the trie)
+    __slots__ = ("state_edges", "edge_dst", "edge_kind", "edge_literal", "literals", "tries", "accepting", "groups",
+                 "rule_starts", "rule_group_counts", "states_merged", "closures", "skip_literal", "first_label_types",
+                 "required_literals", "required_label_types", "uses_labels", "re_pattern", "superset_regexes",
+                 "superset_leading_wildcard", "compiled", "dfa", "dfa_states_max", "state_groups_begin",
+                 "state_groups_end")
 
-    def __init__(self):
-        self.nodes = []
+    def __init__(self, dfa_states_max=DFA_STATES_MAX):
+        # for every state the edges leaving it, in the order they are tried
+        self.state_edges = []
+        self.edge_dst = []
+        self.edge_kind = []
+        self.edge_literal = []
+        self.literals = []
+        # (words, root node) of every trie edge, see add_trie
+        self.tries = []
+        self.accepting = ()
         self.groups = []
+        # for every state the indices of the groups beginning and ending at it, filled in by freeze
+        self.state_groups_begin = ()
+        self.state_groups_end = ()
+        # for every rule its first state and its number of groups, a single pattern is rule 0
+        self.rule_starts = ()
+        self.rule_group_counts = ()
+        # while building, the states merged by add_concat mapped to the state they were merged into
+        self.states_merged = {}
+        # for every state its epsilon closure once computed, see get_closure
+        self.closures = []
+        # (literal, shortest distance, longest distance or None if unbounded) from a match's begin to the literal
+        self.skip_literal = None
+        # label types one of which every match begins with, or None if a match can begin with a literal
+        self.first_label_types = None
+        # literals and label types every match contains, code lacking one of them is not worth parsing or searching
+        self.required_literals = ()
+        self.required_label_types = frozenset()
+        # whether an edge checks a label, if none does the code never needs to be parsed
+        self.uses_labels = True
+        # the equivalent python regex when the search for match begins is delegated to the re module, see
+        # delegate_to_re
+        self.re_pattern = None
+        # regexes the text of every match holds matches of in order, with anything in between, and whether a match
+        # may begin before the first of them, see set_superset
+        self.superset_regexes = ()
+        self.superset_leading_wildcard = False
+        # the generated match_at of the "compiled" engine, False when the automata is too large to generate it
+        self.compiled = None
+        # the LazyDFA of the "dfa" engine of every thread, created on first use, and the most states it caches. the
+        # cap is fixed when the automata is built, as the pattern cache shares it with every caller of the pattern
+        self.dfa = threading.local()
+        self.dfa_states_max = dfa_states_max
 
-    def add_group(self, group_index):
-        self.groups.append((group_index, self.nodes[0], self.nodes[-1]))
-
-    def get_groups_begin(self, node):
-        return [group_index for (group_index, begin_node, _) in self.groups if begin_node == node]
+    def get_groups_begin(self, state):
+        return self.state_groups_begin[state]
 
-    def get_groups_end(self, node):
-        return [group_index for (group_index, _, end_node) in self.groups if end_node == node]
-
-    @staticmethod
-    def get_next_begin(codelines, lineno, col_offset):
-        if col_offset < len(codelines[lineno]) - 1:
-            return lineno, col_offset + 1
-        elif lineno < len(codelines) - 1:
-            return lineno + 1, 0
-        else:
-            return -1, -1
+    def get_groups_end(self, state):
+        return self.state_groups_end[state]
 
+    # the automata is built in place: every add_* method appends the states and edges of a fragment to this
+    # automata's table and returns the fragment as its (first state, last state) pair, so building is linear in the
+    # size of the pattern. finish() then renumbers the states so the whole pattern's fragment starts at 0 and ends
+    # at the last state
     @staticmethod
     def create_automata_matching(string):
         ga = GrammarAutomata()
-        ga.add_node()
-        ga.add_node()
-        cond = GrammarAutomata.Cond("str", string)
-        ga.add_edge(0, 1, cond)
+        ga.finish(ga.add_matching(string))
         return ga
 
     @staticmethod
     def create_automata_meta(meta_type):
         ga = GrammarAutomata()
-        ga.add_node()
-        ga.add_node()
-        cond = GrammarAutomata.Cond(meta_type)
-        ga.add_edge(0, 1, cond)
+        ga.finish(ga.add_meta(meta_type))
         return ga
 
-    @staticmethod
-    def create_automata_or(ga0, ga1):
-        ga = GrammarAutomata()
-        ga.nodes = [GrammarAutomata.Node()] + ga0.nodes + ga1.nodes + [GrammarAutomata.Node()]
-        ga.add_edge(0, 1, GrammarAutomata.Cond("epsilon"))
-        ga.add_edge(0, 1 + len(ga0.nodes), GrammarAutomata.Cond("epsilon"))
-        ga.add_edge(len(ga0.nodes), len(ga.nodes) - 1, GrammarAutomata.Cond("epsilon"))
-        ga.add_edge(len(ga.nodes) - 2, len(ga.nodes) - 1, GrammarAutomata.Cond("epsilon"))
-        ga.groups = ga0.groups + ga1.groups
-        return ga
+    def add_matching(self, string):
+        state_first = self.add_state()
+        state_last = self.add_state()
+        self.add_edge(state_first, state_last, KIND_STR, string)
+        return state_first, state_last
 
-    @staticmethod
-    def create_automata_star(ga0):
-        ga = GrammarAutomata.create_automata_plus(ga0)
-        ga = GrammarAutomata.create_automata_question(ga)
-        ga.groups = ga0.groups
-        return ga
+    def add_meta(self, meta_type):
+        state_first = self.add_state()
+        state_last = self.add_state()
+        self.add_edge(state_first, state_last, LABEL_CODES[meta_type])
+        return state_first, state_last
 
-    @staticmethod
-    def create_automata_plus(ga0):
-        ga = GrammarAutomata()
-        ga.nodes = [GrammarAutomata.Node()] + ga0.nodes + [GrammarAutomata.Node()]
-        ga.add_edge(0, 1, GrammarAutomata.Cond("epsilon"))
-        ga.add_edge(len(ga.nodes) - 2, 1, GrammarAutomata.Cond("epsilon"))
-        ga.add_edge(len(ga.nodes) - 2, len(ga.nodes) - 1, GrammarAutomata.Cond("epsilon"))
-        ga.groups = ga0.groups
-        return ga
+    def add_alternatives(self, fragments):
+        state_first = self.add_state()
+        state_last = self.add_state()
+        for fragment in fragments:
+            self.add_edge(state_first, fragment[0], KIND_EPSILON)
+        for fragment in fragments:
+            self.add_edge(fragment[1], state_last, KIND_EPSILON)
+        return state_first, state_last
+
+    def add_star(self, fragment0):
+        state_first = self.add_state()
+        state_last = self.add_state()
+        self.add_edge(state_first, fragment0[0], KIND_EPSILON)
+        self.add_edge(state_first, state_last, KIND_EPSILON)
+        self.add_edge(fragment0[1], fragment0[0], KIND_EPSILON)
+        self.add_edge(fragment0[1], state_last, KIND_EPSILON)
+        return state_first, state_last
+
+    def add_plus(self, fragment0):
+        state_first = self.add_state()
+        state_last = self.add_state()
+        self.add_edge(state_first, fragment0[0], KIND_EPSILON)
+        self.add_edge(fragment0[1], fragment0[0], KIND_EPSILON)
+        self.add_edge(fragment0[1], state_last, KIND_EPSILON)
+        return state_first, state_last
+
+    def add_question(self, fragment0):
+        state_first = self.add_state()
+        state_last = self.add_state()
+        self.add_edge(state_first, fragment0[0], KIND_EPSILON)
+        self.add_edge(fragment0[1], state_last, KIND_EPSILON)
+        self.add_edge(fragment0[0], state_last, KIND_EPSILON)
+        return state_first, state_last
+
+    # a fragment's first state has no incoming edges and its last state no outgoing ones, so instead of linking
+    # them with an epsilon edge the first state of fragment1 is merged into the last state of fragment0
+    def add_concat(self, fragment0, fragment1):
+        if fragment0 is None:
+            return fragment1
+        self.state_edges[fragment0[1]].extend(self.state_edges[fragment1[0]])
+        self.state_edges[fragment1[0]] = []
+        self.states_merged[fragment1[0]] = fragment0[1]
+        return fragment0[0], fragment1[1]
+
+    def add_group(self, group_index, fragment):
+        self.groups.append((group_index, fragment[0], fragment[1]))
+
+    def add_state(self):
+        self.state_edges.append([])
+        return len(self.state_edges) - 1
+
+    # a single edge matching any of the words (kept in priority order), walking their shared prefix trie once
+    # instead of trying every word as its own alternative
+    def add_trie(self, words):
+        root = {}
+        for word_index, word in enumerate(words):
+            node = root
+            for char in word:
+                node = node.setdefault(char, {})
+            node.setdefault(TRIE_END, word_index)
+        state_first = self.add_state()
+        state_last = self.add_state()
+        self.add_edge(state_first, state_last, KIND_TRIE, (tuple(words), root))
+        return state_first, state_last
+
+    def add_edge(self, state_src, state_dst, kind, literal=None):
+        self.state_edges[state_src].append(len(self.edge_dst))
+        self.edge_dst.append(state_dst)
+        self.edge_kind.append(kind)
+        if kind == KIND_STR:
+            self.edge_literal.append(len(self.literals))
+            self.literals.append(literal)
+        elif kind == KIND_TRIE:
+            self.edge_literal.append(len(self.tries))
+            self.tries.append(literal)
+        else:
+            self.edge_literal.append(-1)
+
+    # renumbers the states so fragment's first state is 0 and its last state is the accepting one, keeping the
+    # creation order of the others and dropping the merged ones, then prepares the automata for matching and extracts
+    # the hints the search uses to skip begin positions
+    def finish(self, fragment):
+        state_first, state_last = fragment
+        self.renumber([state_first] + [state for state in range(len(self.state_edges)) if state != state_first and
+                                       state != state_last and state not in self.states_merged] + [state_last])
+        self.rule_starts = (0,)
+        self.rule_group_counts = (len(self.groups),)
+        self.freeze((len(self.state_edges) - 1,))
+        self.find_skip_literal()
+        self.find_first_label_types()
+        self.find_requirements()
+
+    # finishes the automata of a pattern set from the (fragment, number of groups) pairs of its rules, built side by
+    # side in this automata. every rule keeps its own first and accepting states and numbers its groups from 0, the
+    # rules never share a state so the threads of a rule only ever reach its own accepting state. the begin hints
+    # are left out, they are per rule
+    def finish_set(self, rules):
+        renumbered = self.renumber([state for state in range(len(self.state_edges)) if state not in self.states_merged])
+        self.rule_starts = tuple(renumbered[state_first] for (state_first, _), _ in rules)
+        self.rule_group_counts = tuple(group_count for _, group_count in rules)
+        self.freeze([renumbered[state_last] for (_, state_last), _ in rules])
+
+    # renumbers the states in the given order, mapping the merged ones to the state they were merged into, and
+    # returns the new number of every old state
+    def renumber(self, order):
+        renumbered = [0] * len(self.state_edges)
+        for state_new, state in enumerate(order):
+            renumbered[state] = state_new
+        for state_merged, state in self.states_merged.items():
+            renumbered[state_merged] = renumbered[state]
+        self.state_edges = [self.state_edges[state] for state in order]
+        self.edge_dst = [renumbered[state] for state in self.edge_dst]
+        self.groups = [(group_index, renumbered[begin_state], renumbered[end_state])
+                       for (group_index, begin_state, end_state) in self.groups]
+        self.states_merged = {}
+        return renumbered
+
+    # called once the automata is complete: freezes the arrays into tuples and flags the accepting states
+    def freeze(self, accepting_states):
+        self.state_edges = tuple(tuple(edges) for edges in self.state_edges)
+        self.edge_dst = tuple(self.edge_dst)
+        self.edge_kind = tuple(self.edge_kind)
+        self.edge_literal = tuple(self.edge_literal)
+        self.literals = tuple(self.literals)
+        self.tries = tuple(self.tries)
+        self.groups = tuple(self.groups)
+        groups_begin = [[] for _ in self.state_edges]
+        groups_end = [[] for _ in self.state_edges]
+        for group_index, begin_state, end_state in self.groups:
+            groups_begin[begin_state].append(group_index)
+            groups_end[end_state].append(group_index)
+        self.state_groups_begin = tuple(tuple(group_indices) for group_indices in groups_begin)
+        self.state_groups_end = tuple(tuple(group_indices) for group_indices in groups_end)
+        accepting_states = set(accepting_states)
+        self.accepting = tuple(state in accepting_states for state in range(len(self.state_edges)))
+        self.closures = [None] * len(self.state_edges)
+        self.uses_labels = any(kind < KIND_STR for kind in self.edge_kind)
 
+    # returns the offsets after passing the edge, empty if its condition is not satisfied. text is the code text
+    def check_edge(self, edge, text, labels, offset):
+        kind = self.edge_kind[edge]
+        if kind < KIND_STR:
+            ends = labels.get(offset)
+            return NO_ENDS if ends is None else ends[kind]
+        elif kind == KIND_STR:
+            literal = self.literals[self.edge_literal[edge]]
+            if text.startswith(literal, offset):
+                return offset + len(literal),
+            return NO_ENDS
+        elif kind == KIND_TRIE:
+            return self.check_trie(self.tries[self.edge_literal[edge]][1], text, offset)
+        return offset,
+
+    # walks the text through the trie and returns the ends of the words found, in the priority order of the words
     @staticmethod
-    def create_automata_question(ga0):
-        ga = GrammarAutomata()
-        ga.nodes = [GrammarAutomata.Node()] + ga0.nodes + [GrammarAutomata.Node()]
-        ga.add_edge(0, 1, GrammarAutomata.Cond("epsilon"))
-        ga.add_edge(len(ga.nodes) - 2, len(ga.nodes) - 1, GrammarAutomata.Cond("epsilon"))
-        ga.add_edge(1, len(ga.nodes) - 1, GrammarAutomata.Cond("epsilon"))
-        ga.groups = ga0.groups
-        return ga
+    def check_trie(node, text, offset):
+        found = []
+        for end in range(offset, len(text)):
+            node = node.get(text[end])
+            if node is None:
+                break
+            if TRIE_END in node:
+                found.append((node[TRIE_END], end + 1))
+        if len(found) == 0:
+            return NO_ENDS
+        found.sort()
+        return tuple(end for _, end in found)
+
+    def epsilon_closure(self, states):
+        closure = set()
+        stack = list(states)
+        while len(stack) > 0:
+            state = stack.pop()
+            if state in closure:
+                continue
+            closure.add(state)
+            for edge in self.state_edges[state]:
+                if self.edge_kind[edge] == KIND_EPSILON:
+                    stack.append(self.edge_dst[edge])
+        return closure
+
+    # the epsilon free view of the automata the engines run on. the closure of a state is the non epsilon edges
+    # reachable from it through epsilon edges, each with the tags of the path to it, and the tags of the path to the
+    # accepting state or None when it is not reachable. a tag is the capture slot of a group begin (2 * group index)
+    # or end (2 * group index + 1) to set to the current position. paths are explored breadth first and the first
+    # one to reach a state is kept. closures are computed on first use so compiling stays linear
+    def get_closure(self, state):
+        closure = self.closures[state]
+        if closure is None:
+            closure = self.closures[state] = self.compute_closure(state)
+        return closure
+
+    def compute_closure(self, state_begin):
+        tags = {state_begin: self.get_state_tags(state_begin)}
+        queue = [state_begin]
+        closure_edges = []
+        closure_accept = None
+        for state in queue:
+            if self.accepting[state]:
+                closure_accept = tags[state]
+            for edge in self.state_edges[state]:
+                if self.edge_kind[edge] != KIND_EPSILON:
+                    closure_edges.append((edge, tags[state]))
+                elif self.edge_dst[edge] not in tags:
+                    tags[self.edge_dst[edge]] = tags[state] + self.get_state_tags(self.edge_dst[edge])
+                    queue.append(self.edge_dst[edge])
+        return tuple(closure_edges), closure_accept
+
+    def get_state_tags(self, state):
+        return tuple([2 * group_index for group_index in self.state_groups_begin[state]] +
+                     [2 * group_index + 1 for group_index in self.state_groups_end[state]])
+
+    # edges leaving the epsilon closure of the first state, that is the edges a match can begin with. None when the
+    # empty string matches
+    def get_first_edges(self):
+        closure = self.epsilon_closure([0])
+        if len(self.state_edges) - 1 in closure:
+            return None
+        return [edge for state in closure for edge in self.state_edges[state] if self.edge_kind[edge] != KIND_EPSILON]
+
+    # the longest literal every match begins with, that is the common prefix of the first literals of all paths
+    def get_leading_literal(self):
+        edges = self.get_first_edges()
+        if not edges or any(self.edge_kind[edge] != KIND_STR and self.edge_kind[edge] != KIND_TRIE for edge in edges):
+            return None
+        prefix = os.path.commonprefix([self.edge_prefix(edge) for edge in edges])
+        return prefix if len(prefix) > 0 else None
+
+    # the literal every string passing a str or trie edge begins with
+    def edge_prefix(self, edge):
+        if self.edge_kind[edge] == KIND_TRIE:
+            return os.path.commonprefix(self.tries[self.edge_literal[edge]][0])
+        return self.literals[self.edge_literal[edge]]
+
+    # literal edges that every path from the first state to the accepting one passes through, together with the
+    # shortest and longest (None when unbounded) distance from the first state to the edge
+    def get_required_literals(self):
+        distance_min, distance_max = self.get_distance_ranges()
+        required = []
+        for state, edge in self.get_required_edges():
+            if self.edge_kind[edge] == KIND_STR or self.edge_kind[edge] == KIND_TRIE:
+                literal = self.edge_prefix(edge)
+                if len(literal) > 0:
+                    required.append((literal, distance_min[state], distance_max[state]))
+        return required
+
+    # the (source state, edge) pairs every path from the first state to the accepting one passes through, in path
+    # order. a path to the accepting state is walked and an edge of it is required when nothing reached from the
+    # path before the edge leads past it, every state is explored once so this is linear in the automata's size
+    def get_required_edges(self):
+        state_accept = len(self.state_edges) - 1
+        edge_parent = {0: None}
+        queue = [0]
+        for state in queue:
+            for edge in self.state_edges[state]:
+                if self.edge_dst[edge] not in edge_parent:
+                    edge_parent[self.edge_dst[edge]] = (state, edge)
+                    queue.append(self.edge_dst[edge])
+        if state_accept not in edge_parent:
+            return []
+        path = []
+        state = state_accept
+        while edge_parent[state] is not None:
+            path.append(edge_parent[state])
+            state = edge_parent[state][0]
+        path.reverse()
+        # the path's i-th edge has index 2 * i + 1, the state it leaves 2 * i and the one it enters 2 * i + 2
+        path_state_index = {0: 0}
+        path_edge_index = {}
+        for i, (_, edge) in enumerate(path):
+            path_edge_index[edge] = 2 * i + 1
+            path_state_index[self.edge_dst[edge]] = 2 * i + 2
+        explored = set()
+        farthest = 0
+        required = []
+        for i, (state_src, edge_path) in enumerate(path):
+            stack = [state_src]
+            while len(stack) > 0:
+                state = stack.pop()
+                for edge in self.state_edges[state]:
+                    if edge in path_edge_index:
+                        farthest = max(farthest, path_edge_index[edge])
+                        continue
+                    state_dst = self.edge_dst[edge]
+                    if state_dst in path_state_index:
+                        farthest = max(farthest, path_state_index[state_dst])
+                    elif state_dst not in explored:
+                        explored.add(state_dst)
+                        stack.append(state_dst)
+            if farthest == 2 * i + 1:
+                required.append((state_src, edge_path))
+            # the edge's destination is reached and explored next
+            farthest = max(farthest, 2 * i + 2)
+        return required
+
+    # the shortest (or longest) length of the strings passing the edge
+    def edge_length(self, edge, longest=False):
+        kind = self.edge_kind[edge]
+        if kind == KIND_STR:
+            return len(self.literals[self.edge_literal[edge]])
+        elif kind == KIND_TRIE:
+            lengths = [len(word) for word in self.tries[self.edge_literal[edge]][0]]
+            return max(lengths) if longest else min(lengths)
+        elif kind == KIND_EPSILON:
+            return 0
+        # labels are never empty but have no upper bound
+        return 1
+
+    # for every state the shortest and longest (None when unbounded) distance from the first state
+    def get_distance_ranges(self):
+        distance_min = [None] * len(self.state_edges)
+        distance_min[0] = 0
+        heap = [(0, 0)]
+        while len(heap) > 0:
+            distance, state = heappop(heap)
+            if distance > distance_min[state]:
+                continue
+            for edge in self.state_edges[state]:
+                state_dst = self.edge_dst[edge]
+                distance_dst = distance + self.edge_length(edge)
+                if distance_min[state_dst] is None or distance_dst < distance_min[state_dst]:
+                    distance_min[state_dst] = distance_dst
+                    heappush(heap, (distance_dst, state_dst))
+        # longest distance in topological order, the states after a loop are never ordered and stay unbounded, as
+        # do the states after a label
+        in_degree = [0] * len(self.state_edges)
+        for state_dst in self.edge_dst:
+            in_degree[state_dst] += 1
+        longest = [0] * len(self.state_edges)
+        bounded = [True] * len(self.state_edges)
+        distance_max = [None] * len(self.state_edges)
+        ready = [state for state in range(len(self.state_edges)) if in_degree[state] == 0]
+        while len(ready) > 0:
+            state = ready.pop()
+            if bounded[state]:
+                distance_max[state] = longest[state]
+            for edge in self.state_edges[state]:
+                state_dst = self.edge_dst[edge]
+                if not bounded[state] or self.edge_kind[edge] < KIND_STR:
+                    bounded[state_dst] = False
+                else:
+                    longest[state_dst] = max(longest[state_dst], longest[state] + self.edge_length(edge, True))
+                in_degree[state_dst] -= 1
+                if in_degree[state_dst] == 0:
+                    ready.append(state_dst)
+        return distance_min, distance_max
 
     @staticmethod
-    def create_automata_concat(ga0, ga1):
-        if ga0 is None:
-            return ga1
-        ga = GrammarAutomata()
-        ga.nodes = ga0.nodes + ga1.nodes
-        ga.add_edge(len(ga0.nodes) - 1, len(ga0.nodes), GrammarAutomata.Cond("epsilon"))
-        ga.groups = ga0.groups + ga1.groups
-        return ga
+    def literal_rarity(literal):
+        return sum(COMMON_CHARACTERS.find(c) if c in COMMON_CHARACTERS else len(COMMON_CHARACTERS) for c in literal)
+
+    # picks the literal the search jumps between with str.find, preferring literals at a bounded distance from the
+    # match begin (the begin can then be computed back from the literal) and among those the rarest one
+    def find_skip_literal(self):
+        candidates = self.get_required_literals()
+        leading = self.get_leading_literal()
+        if leading is not None:
+            candidates.append((leading, 0, 0))
+        bounded = [candidate for candidate in candidates if candidate[2] is not None]
+        if len(bounded) > 0:
+            candidates = bounded
+        self.skip_literal = max(candidates, key=lambda candidate: self.literal_rarity(candidate[0]), default=None)
+
+    def find_first_label_types(self):
+        edges = self.get_first_edges()
+        if not edges or any(self.edge_kind[edge] >= KIND_STR for edge in edges):
+            self.first_label_types = None
+        else:
+            self.first_label_types = frozenset(LABEL_TYPES[self.edge_kind[edge]] for edge in edges)
+
+    def find_requirements(self):
+        literals = [literal for literal, _, _ in self.get_required_literals()]
+        if self.skip_literal is not None:
+            literals.append(self.skip_literal[0])
+        self.required_literals = tuple(dict.fromkeys(literals))
+        self.required_label_types = frozenset(LABEL_TYPES[self.edge_kind[edge]] for _, edge in self.get_required_edges()
+                                              if self.edge_kind[edge] < KIND_STR)
+
+    # whether the source holds every required literal, checked on the code text before it is parsed
+    def literals_occur(self, source):
+        return all(literal in source for literal in self.required_literals)
+
+    # sets the sequence of regexes and wildcards (None) RegExParser.tree_to_superset over approximates the pattern by
+    def set_superset(self, sequence):
+        self.superset_regexes = tuple(re.compile(item) for item in sequence if item is not None)
+        self.superset_leading_wildcard = sequence[0] is None
+
+    # whether the source holds a hit of the superset, checked on the code text before it is parsed
+    def superset_occurs(self, source):
+        return len(self.superset_regexes) == 0 or self.superset_finder(source)(0) is not None
+
+    # returns a function mapping an offset into text to the first offset at or after it where the superset regexes
+    # match in order, or None. the regexes are searched one after the other, each from where the previous one
+    # matches, and the search of every regex is reused while later queries stay within what it already scanned
+    def superset_finder(self, text):
+        regexes = self.superset_regexes
+        # for every regex, the offset it was last searched from and its first match there (None if there is none)
+        searched = [None] * len(regexes)
+        found = [None] * len(regexes)
+
+        def find(offset):
+            for i, regex in enumerate(regexes):
+                if searched[i] is None or offset < searched[i] or (found[i] is not None and offset > found[i]):
+                    match = regex.search(text, offset)
+                    searched[i] = offset
+                    found[i] = None if match is None else match.start()
+                if found[i] is None:
+                    return None
+                offset = found[i]
+            return found[0]
+        return find
+
+    # begin finder for the superset, on the code text
+    def superset_begin_finder(self, code):
+        if len(self.superset_regexes) == 0:
+            return lambda offset: offset
+        find = self.superset_finder(code.text)
+
+        def next_begin(offset):
+            start = find(offset)
+            if start is None or self.superset_leading_wildcard:
+                return None if start is None else offset
+            return start
+        return next_begin
+
+    # whether the labels hold every required label type, checked before searching the labeled code
+    def label_types_occur(self, labels):
+        return all(labels.has_type(label_type) for label_type in self.required_label_types)
 
-    def add_node(self):
-        self.nodes.append(GrammarAutomata.Node())
+    # returns a function mapping a begin offset to the first offset at or after it where a match could begin, or
+    # None when no match can begin anymore. code is the CodeText, occurrences are the sorted offsets of the skip
+    # literal when they were already found, see literal_begin_finder. as when the begins are stepped through with
+    # CodeText.next_begin, the end of a line that is not empty is only a begin when it is the offset asked for, that
+    # is right after a match ending there
+    def begin_finder(self, code, labels, occurrences=None):
+        find = self.candidate_finder(code, labels, occurrences)
 
-    def add_edge(self, id_src, id_dst, cond):
-        self.nodes[id_src].add_edge(self.nodes[id_dst], cond)
+        def next_begin(offset):
+            begin = find(offset)
+            while begin is not None and begin != offset and code.is_line_end(begin):
+                begin = find(begin + 1)
+            return begin
+        return next_begin
+
+    # the begin finder of the hints, the offsets it returns may be line ends
+    def candidate_finder(self, code, labels, occurrences=None):
+        if self.re_pattern is not None:
+            return self.re_begin_finder(code)
+        next_begin_literal = self.literal_begin_finder(code, occurrences)
+        if len(self.superset_regexes) > 0:
+            next_begin_superset = self.superset_begin_finder(code)
+            next_begin_skip = next_begin_literal
+
+            def next_begin_literal(offset):
+                offset = next_begin_skip(offset)
+                return None if offset is None else next_begin_superset(offset)
+        if self.first_label_types is None:
+            return next_begin_literal
+        # only the offsets where a label of the first types begins are worth trying
+        starts = labels.get_starts(self.first_label_types)
+
+        def next_begin(offset):
+            offset = next_begin_literal(offset)
+            if offset is None:
+                return None
+            i = bisect_left(starts, offset)
+            return starts[i] if i < len(starts) else None
+        return next_begin
+
+    # begin finder for the skip literal, it caches the last occurrence so it is cheap to call for every offset.
+    # the occurrences are searched with str.find unless their sorted offsets are given
+    def literal_begin_finder(self, code, occurrences=None):
+        if self.skip_literal is None:
+            return lambda offset: offset
+        literal, prefix_min, prefix_max = self.skip_literal
+        text = code.text
+        occurrence_last = [None]
+
+        def find(offset):
+            if occurrences is not None:
+                i = bisect_left(occurrences, offset)
+                return occurrences[i] if i < len(occurrences) else None
+            offset = text.find(literal, offset)
+            return None if offset == -1 else offset
+
+        def next_begin(offset):
+            if prefix_max is None:
+                # the begin can not be computed back from the literal, but without another occurrence nothing matches
+                if occurrence_last[0] is None or occurrence_last[0] < offset:
+                    occurrence_last[0] = find(offset)
+                    if occurrence_last[0] is None:
+                        return None
+                return offset
+            occurrence = find(offset + prefix_min)
+            if occurrence is None:
+                return None
+            return max(offset, occurrence - prefix_max)
+        return next_begin
 
     def print_graph(self):
-        for node in self.nodes:
-            print("NODE", hex(id(node)), ":")
-            for edge in node.edges:
-                print("EDGE TO", hex(id(edge[0])), "WITH COND TYPE:", edge[1].type, "STR:", edge[1].str)
+        for state, edges in enumerate(self.state_edges):
+            print("STATE", state, ":")
+            for edge in edges:
+                kind = self.edge_kind[edge]
+                kind_name = LABEL_TYPES[kind] if kind < KIND_STR else ("str", "epsilon", "trie")[kind - KIND_STR]
+                literal = self.literals[self.edge_literal[edge]] if kind == KIND_STR else \
+                    self.tries[self.edge_literal[edge]][0] if kind == KIND_TRIE else ""
+                print("EDGE TO", self.edge_dst[edge], "WITH COND TYPE:", kind_name, "STR:", literal)
 
     # def display_graph(self):
     #     dot = graphviz.Digraph(comment='Automata')
-    #     for i, node in enumerate(self.nodes):
-    #         dot.node(hex(id(node)), str(i))
-    #         for edge in node.edges:
-    #             if edge[1].type == "str":
-    #                 dot.edge(hex(id(node)), hex(id(edge[0])), edge[1].type + ":'" + edge[1].str + "'")
+    #     for state, edges in enumerate(self.state_edges):
+    #         dot.node(str(state), str(state))
+    #         for edge in edges:
+    #             if self.edge_kind[edge] == KIND_STR:
+    #                 literal = self.literals[self.edge_literal[edge]]
+    #                 dot.edge(str(state), str(self.edge_dst[edge]), "str:'" + literal + "'")
     #             else:
-    #                 dot.edge(hex(id(node)), hex(id(edge[0])), edge[1].type)
+    #                 dot.edge(str(state), str(self.edge_dst[edge]), str(self.edge_kind[edge]))
     #     dot.render('doctest-output/automata.gv', view=True)
     #     pass
 
-    # this has a bug with repeating groups (many instances of a group in a single match)
-    def consolidate_groups(self, groups):
-        index_to_range = {}
-        for (lineno, col_offset), groups_begin in groups[0].items():
-            for group_index in groups_begin:
-                if group_index not in index_to_range:
-                    index_to_range[group_index] = [(lineno, col_offset), None]
-        for (lineno, col_offset), groups_end in groups[1].items():
-            for group_index in groups_end:
-                if group_index in index_to_range:
-                    index_to_range[group_index][1] = (lineno, col_offset)
-        # remove uncompleted groups
-        index_to_range = {k: [(l[0], l[1])] for k, l in index_to_range.items() if l[1] is not None}
-        return index_to_range
-
-    def match_generator(self, codelines, labels):
-        lineno_begin = 0
-        col_offset_begin = 0
-        while lineno_begin != -1:
-            stack = [(self.nodes[0], lineno_begin, col_offset_begin)]
-            group_markers = {}, {}
-            last_match_end = None
-            while len(stack) > 0:
-                node, lineno, col_offset = stack[-1]
-                stack.pop()
-                groups_begin = self.get_groups_begin(node)
-                groups_end = self.get_groups_end(node)
-                if len(groups_begin) > 0:
-                    group_markers[0][(lineno, col_offset)] = groups_begin
-                if len(groups_end) > 0:
-                    group_markers[1][(lineno, col_offset)] = groups_end
-                for node_dst, cond in node.edges:
-                    satisfied, listends = cond.check(codelines, labels, lineno, col_offset)
-                    if satisfied:
-                        if node_dst == self.nodes[-1]:
-                            last_match_end = self.last_listend(listends)
-                        for ends in listends:
-                            stack.append((node_dst, ends[0], ends[1]))
-            if last_match_end is not None:
-                yield ((lineno_begin, col_offset_begin), last_match_end), self.consolidate_groups(group_markers)
-                # avoid collisions
-                lineno_begin, col_offset_begin = last_match_end
-                if lineno_begin == len(codelines) - 1 and col_offset_begin == len(codelines[lineno_begin]):
-                    lineno_begin, col_offset_begin = -1, -1
+    # memoized search from a single start offset, every (state, offset) pair is expanded at most once so the work
+    # is bounded by states * offsets even for nested or empty loops, the pair is kept in the visited set as the
+    # single integer offset * states + state. the successors of a configuration are explored in the order of
+    # priority of their edges, each configuration keeps the captures of the first path to reach it and the match
+    # keeps those of the first path to reach the longest end. text is the code text, returns the longest match end
+    # (or None) and its captures. when end is given no configuration past it is explored, offsets never decrease so
+    # the ones up to it are reached in the same order and the match ending at end keeps the same captures
+    def match_at(self, text, labels, begin, end=None):
+        state_count = len(self.state_edges)
+        stack = [(0, begin, NO_CAPTURES)]
+        visited = set()
+        match_end = None
+        match_captures = NO_CAPTURES
+        while len(stack) > 0:
+            state, offset, captures = stack.pop()
+            configuration = offset * state_count + state
+            if configuration in visited:
+                continue
+            visited.add(configuration)
+            closure_edges, closure_accept = self.get_closure(state)
+            if closure_accept is not None and (match_end is None or offset > match_end):
+                match_end = offset
+                match_captures = self.apply_tags(captures, closure_accept, offset)
+            # pushed last to first, so the first is popped first
+            for edge, tags in reversed(closure_edges):
+                listends = self.check_edge(edge, text, labels, offset)
+                if len(listends) == 0:
+                    continue
+                state_dst = self.edge_dst[edge]
+                captures_dst = self.apply_tags(captures, tags, offset)
+                for end_dst in reversed(listends):
+                    if (end is None or end_dst <= end) and end_dst * state_count + state_dst not in visited:
+                        stack.append((state_dst, end_dst, captures_dst))
+        return match_end, match_captures
+
+    # the "compiled" engine's match_at: match_at specialised to this automata as python source, generated and
+    # compiled on first use and kept with the automata (and so with the pattern in the cache). every reachable state
+    # becomes a function with its closure unrolled, literals are checked by inline startswith calls and labels by
+    # direct indexing into the label tuples. None when the automata is too large to be worth generating
+    def compiled_match_at(self):
+        if self.compiled is None:
+            source = self.generate_match_source()
+            if source is None:
+                self.compiled = False
+            else:
+                namespace = {"NO_ENDS": NO_ENDS, "NO_CAPTURES": NO_CAPTURES, "check_trie": self.check_trie,
+                             "tries": tuple(root for _, root in self.tries)}
+                exec(compile(source, "<automata>", "exec"), namespace)
+                self.compiled = namespace["match_at"]
+        return self.compiled or None
+
+    # the source of the compiled match_at, it explores the same configurations in the same order as match_at and so
+    # finds the same match ends and groups
+    def generate_match_source(self):
+        states = [0] + sorted(set(self.edge_dst[edge] for edge in range(len(self.edge_dst))
+                                  if self.edge_kind[edge] != KIND_EPSILON))
+        closures = {state: self.get_closure(state) for state in states}
+        if sum(len(closure_edges) for closure_edges, _ in closures.values()) > CODEGEN_EDGES_MAX:
+            return None
+        state_count = len(self.state_edges)
+        lines = []
+        for state in states:
+            lines += self.generate_state_source(state, *closures[state])
+        lines += ["states = [{}]".format(", ".join("state_{}".format(state) if state in closures else "None"
+                                                   for state in range(state_count))),
+                  "",
+                  "def match_at(text, labels, begin):",
+                  "    stack = [(0, begin, NO_CAPTURES)]",
+                  "    visited = set()",
+                  "    match_end = None",
+                  "    match_captures = NO_CAPTURES",
+                  "    while stack:",
+                  "        state, offset, captures = stack.pop()",
+                  "        configuration = offset * {} + state".format(state_count),
+                  "        if configuration in visited:",
+                  "            continue",
+                  "        visited.add(configuration)",
+                  "        accept = states[state](text, labels, offset, captures, stack, visited)",
+                  "        if accept is not None and (match_end is None or accept[0] > match_end):",
+                  "            match_end, match_captures = accept",
+                  "    return match_end, match_captures",
+                  ""]
+        return "\n".join(lines)
+
+    # the function of a state, returns its offset and captures if the state accepts there
+    def generate_state_source(self, state, closure_edges, closure_accept):
+        state_count = len(self.state_edges)
+        lines = ["def state_{}(text, labels, offset, captures, stack, visited):".format(state)]
+        if any(self.edge_kind[edge] < KIND_STR for edge, _ in closure_edges):
+            lines.append("    ends = labels.get(offset)")
+        for edge, tags in reversed(closure_edges):
+            kind, state_dst = self.edge_kind[edge], self.edge_dst[edge]
+            captures_dst = self.generate_tags_source(tags)
+            if kind == KIND_STR:
+                literal = self.literals[self.edge_literal[edge]]
+                # the configuration after the literal, offset * states + state with the constant part folded
+                configuration = "offset * {} + {}".format(state_count, len(literal) * state_count + state_dst)
+                lines += ["    if text.startswith({!r}, offset):".format(literal),
+                          "        if {} not in visited:".format(configuration),
+                          "            stack.append(({}, offset + {}, {}))".format(state_dst, len(literal),
+                                                                                  captures_dst)]
+                continue
+            if kind == KIND_TRIE:
+                trie = self.edge_literal[edge]
+                lines += ["    listends = check_trie(tries[{}], text, offset)".format(trie),
+                          "    if len(listends) > 0:"]
+            else:
+                lines += ["    listends = NO_ENDS if ends is None else ends[{}]".format(kind),
+                          "    if len(listends) > 0:"]
+            lines += ["        captures_dst = {}".format(captures_dst),
+                      "        for end in reversed(listends):",
+                      "            if end * {} + {} not in visited:".format(state_count, state_dst),
+                      "                stack.append(({}, end, captures_dst))".format(state_dst)]
+        if closure_accept is None:
+            lines += ["    return None", ""]
+        else:
+            lines += ["    return offset, {}".format(self.generate_tags_source(closure_accept)), ""]
+        return lines
+
+    # apply_tags unrolled for the given tags, as an expression
+    @staticmethod
+    def generate_tags_source(tags):
+        captures = "captures"
+        for slot in tags:
+            captures = "({}, offset, {})".format(slot, captures)
+        return captures
+
+    # the LazyDFA of the calling thread. the pattern cache shares automatas between threads and a dfa grows (and is
+    # flushed) while it is used, so every thread builds its own
+    def get_dfa(self):
+        dfa = getattr(self.dfa, "automata", None)
+        if dfa is None:
+            dfa = self.dfa.automata = LazyDFA(self, self.dfa_states_max)
+        return dfa
+
+    # a match_at without groups, the lazy dfa finds the longest match end
+    def dfa_match_at(self, text, labels, begin):
+        return self.get_dfa().longest_match(text, labels, begin), None
+
+    # breadth first (thompson / pike vm) simulation from a single start offset. offsets are visited in order,
+    # threads waiting at an offset are deduplicated by state and by edge, and a satisfied label schedules its
+    # thread at the label's end offset. each thread carries its own group captures, so the groups are those of
+    # the path that reached the longest match end
+    def pike_match_at(self, text, labels, begin):
+        matches = self.pike_rules_match_at(text, labels, begin, (0,))
+        if len(matches) == 0:
+            return None, NO_CAPTURES
+        return matches[0]
+
+    # the pike simulation of several rules from the same start offset at once, a thread carries its rule and
+    # since rules share no state their threads never interfere. returns rule -> (longest match end, captures) for
+    # the rules that matched
+    def pike_rules_match_at(self, text, labels, begin, rules):
+        pending = {begin: [(self.rule_starts[rule], rule, NO_CAPTURES) for rule in rules]}
+        offsets = [begin]
+        matches = {}
+        while len(offsets) > 0:
+            offset = heappop(offsets)
+            threads = pending.pop(offset)
+            seen = set()
+            edges_taken = set()
+            rules_accepted = set()
+            # threads reached through empty edges are appended to the list while it is being walked
+            i = 0
+            while i < len(threads):
+                state, rule, captures = threads[i]
+                i += 1
+                if state in seen:
+                    continue
+                seen.add(state)
+                closure_edges, closure_accept = self.get_closure(state)
+                if closure_accept is not None and rule not in rules_accepted:
+                    rules_accepted.add(rule)
+                    matches[rule] = (offset, self.apply_tags(captures, closure_accept, offset))
+                for edge, tags in closure_edges:
+                    if edge in edges_taken:
+                        continue
+                    edges_taken.add(edge)
+                    listends = self.check_edge(edge, text, labels, offset)
+                    if len(listends) == 0:
+                        continue
+                    state_dst = self.edge_dst[edge]
+                    captures_dst = self.apply_tags(captures, tags, offset)
+                    for end in listends:
+                        if end == offset:
+                            threads.append((state_dst, rule, captures_dst))
+                        else:
+                            if end not in pending:
+                                pending[end] = []
+                                heappush(offsets, end)
+                            pending[end].append((state_dst, rule, captures_dst))
+        return matches
+
+    # unanchored pike vm, a single forward scan that starts a thread at every candidate begin offset (like a lazy
+    # .*? prefix) instead of rerunning the automata per offset. threads carry their start and when two of them
+    # meet at a state the leftmost start wins. a match is reported once no thread with an earlier or equal start is
+    # alive, which keeps the leftmost longest non overlapping matches of match_generator
+    def unanchored_match_generator(self, code, labels):
+        if len(code.lines) == 0:
+            return
+        resume = 0
+        while resume is not None:
+            resume = yield from self.unanchored_scan(code, labels, resume)
+
+    # scans from offset_begin, returns the offset to rescan from when a reported match invalidated threads that
+    # were shadowed by an overlapping one, or None when the code is exhausted
+    def unanchored_scan(self, code, labels, offset_begin):
+        text = code.text
+        offset_last = len(text)
+        pending = {}
+        offsets = []
+        # start -> (longest end so far, captures), with the accepted starts in a heap
+        accepted = {}
+        accepted_starts = []
+        # start -> number of pending threads from it, with those starts in a heap. a start whose threads all ran is
+        # dropped from the counts and left in the heap until it comes first
+        live = {}
+        live_starts = []
+
+        def first_live_start():
+            while len(live_starts) > 0 and live_starts[0] not in live:
+                heappop(live_starts)
+            return live_starts[0] if len(live_starts) > 0 else None
+
+        def drop_live(start):
+            live[start] -= 1
+            if live[start] == 0:
+                del live[start]
+        # (start of the thread that claimed a state, edge or the accepting state, start of the thread it shadowed)
+        shadowed = set()
+        next_begin = self.begin_finder(code, labels)
+        candidate = next_begin(offset_begin)
+        exhausted = False
+        while not exhausted:
+            if len(offsets) > 0 and (candidate is None or offsets[0] <= candidate):
+                offset = heappop(offsets)
+                threads = pending.pop(offset)
+                for thread in threads:
+                    drop_live(thread[1])
+            elif candidate is not None:
+                offset = candidate
+                threads = []
             else:
-                lineno_begin, col_offset_begin = self.get_next_begin(codelines, lineno_begin, col_offset_begin)
+                exhausted = True
+                threads = []
+            if not exhausted:
+                if offset == candidate:
+                    threads.append((0, offset, NO_CAPTURES))
+                    candidate = code.next_begin(offset)
+                    candidate = None if candidate == -1 else next_begin(candidate)
+                threads.sort(key=lambda thread: thread[1])
+                claimed_states = {}
+                claimed_edges = {}
+                claimed_accept = None
+                for _, threads_start in groupby(threads, key=lambda thread: thread[1]):
+                    # threads reached through empty edges are appended while the list is walked, as in pike_match_at
+                    threads_start = list(threads_start)
+                    i = 0
+                    while i < len(threads_start):
+                        state, start, captures = threads_start[i]
+                        i += 1
+                        if state in claimed_states:
+                            if claimed_states[state] != start:
+                                shadowed.add((claimed_states[state], start))
+                            continue
+                        claimed_states[state] = start
+                        closure_edges, closure_accept = self.get_closure(state)
+                        if closure_accept is not None:
+                            if claimed_accept is None:
+                                claimed_accept = start
+                                if start not in accepted:
+                                    heappush(accepted_starts, start)
+                                if start not in accepted or accepted[start][0] < offset:
+                                    accepted[start] = (offset, self.apply_tags(captures, closure_accept, offset))
+                            elif claimed_accept != start:
+                                shadowed.add((claimed_accept, start))
+                        for edge, tags in closure_edges:
+                            if edge in claimed_edges:
+                                if claimed_edges[edge] != start:
+                                    shadowed.add((claimed_edges[edge], start))
+                                continue
+                            claimed_edges[edge] = start
+                            listends = self.check_edge(edge, text, labels, offset)
+                            if len(listends) == 0:
+                                continue
+                            state_dst = self.edge_dst[edge]
+                            captures_dst = self.apply_tags(captures, tags, offset)
+                            for end in listends:
+                                if end == offset:
+                                    threads_start.append((state_dst, start, captures_dst))
+                                else:
+                                    if end not in pending:
+                                        pending[end] = []
+                                        heappush(offsets, end)
+                                    pending[end].append((state_dst, start, captures_dst))
+                                    if start not in live:
+                                        live[start] = 0
+                                        heappush(live_starts, start)
+                                    live[start] += 1
+            while len(accepted) > 0:
+                start = accepted_starts[0]
+                start_live = first_live_start()
+                if start_live is not None and start_live <= start:
+                    break
+                heappop(accepted_starts)
+                end, captures = accepted.pop(start)
+                yield (start, end), captures
+                if end == offset_last:
+                    return None
+                if end == start:
+                    resume = code.next_begin(start)
+                    if resume == -1:
+                        return None
+                else:
+                    resume = end
+                    # the end of a line is only tried as a begin offset right after a match, where it can hold
+                    # an empty match
+                    if code.is_line_end(end) and self.is_nullable():
+                        return resume
+                if any(start_claimed < resume <= start_shadowed for start_claimed, start_shadowed in shadowed):
+                    return resume
+                shadowed = {(start_claimed, start_shadowed) for start_claimed, start_shadowed in shadowed
+                            if start_claimed >= resume}
+                while len(accepted_starts) > 0 and accepted_starts[0] < resume:
+                    del accepted[heappop(accepted_starts)]
+                start_live = first_live_start()
+                if start_live is not None and start_live < resume:
+                    for end_pending in pending:
+                        threads_kept = []
+                        for thread in pending[end_pending]:
+                            if thread[1] >= resume:
+                                threads_kept.append(thread)
+                            else:
+                                drop_live(thread[1])
+                        pending[end_pending] = threads_kept
+        return None
 
-    def last_listend(self, listends):
-        last = listends[0]
-        for i in range(1, len(listends)):
-            curr = listends[i]
-            if curr[0] > last[0] or (curr[0] == last[0] and curr[1] > last[1]):
-                last = curr
-        return last
+    # the captures of a thread are the tags set along its path, most recent first, as a persistent linked list of
+    # (slot, offset, captures before) cells. threads forking from a thread share its cells, so setting a tag is a
+    # single allocation whatever the number of groups
+    @staticmethod
+    def apply_tags(captures, tags, offset):
+        for slot in tags:
+            captures = (slot, offset, captures)
+        return captures
 
-    def match_all(self, codelines: list, labels):
-        return [m for (m, _) in self.match_generator(codelines, labels)]
+    # groups maps the index of every group with a complete capture to its ranges: the range of its last iteration,
+    # or of every iteration in order when all_iterations is set. a begin with no end after it is not a capture
+    @staticmethod
+    def captures_to_groups(captures, all_iterations=False):
+        tags = []
+        while captures is not NO_CAPTURES:
+            slot, offset, captures = captures
+            tags.append((slot, offset))
+        groups = {}
+        group_begins = {}
+        for slot, offset in reversed(tags):
+            group_index = slot // 2
+            if slot % 2 == 0:
+                group_begins[group_index] = offset
+            elif group_index in group_begins:
+                group_range = (group_begins.pop(group_index), offset)
+                if all_iterations and group_index in groups:
+                    groups[group_index].append(group_range)
+                else:
+                    groups[group_index] = [group_range]
+        return {group_index: groups[group_index] for group_index in sorted(groups)}
 
-    def match_first(self, codelines: list, labels):
-        return next(self.match_generator(codelines, labels))[0]
+    # whether the empty string is accepted, that is the accepting state is reachable through epsilon edges only
+    def is_nullable(self):
+        return self.get_closure(0)[1] is not None
+
+    # engine None lets the search pick, it is "dfa": the lazy dfa finds the spans and the backtrack search the groups
+    @staticmethod
+    def check_engine(engine):
+        if engine is not None and engine not in ENGINES:
+            raise ValueError("Unknown matching engine: {}".format(engine))
+
+    # yields (match range, groups) pairs, see captures_to_groups for the groups. codelines is the list of code lines
+    # or their CodeText, the ranges are ((lineno, col_offset), (end_lineno, end_col_offset)) positions
+    def match_generator(self, codelines, labels, engine=None, all_iterations=False):
+        code = CodeText.of(codelines)
+        position_range, position_ranges = code.range, code.ranges
+        for match, groups in self.offset_match_generator(code, labels, engine, all_iterations):
+            yield position_range(match), position_ranges(groups) if len(groups) > 0 else groups
+
+    # match_generator with the ranges left as offsets into the code text
+    def offset_match_generator(self, code, labels, engine=None, all_iterations=False):
+        self.check_engine(engine)
+        if engine == "unanchored":
+            matches = self.unanchored_match_generator(code, labels)
+        elif engine is None or engine == "dfa":
+            # the spans are found without tracking groups, and the groups of the matches only, by a search that
+            # stays within the match
+            matches = ((match, self.match_at(code.text, labels, match[0], match[1])[1])
+                       for match, _ in self.span_matches(code, labels, "dfa"))
+        else:
+            matches = self.anchored_match_generator(code, labels, self.engine_match_at(engine))
+        for match, captures in matches:
+            yield match, self.captures_to_groups(captures, all_iterations)
+
+    # the match ranges of match_generator without their groups. the match ends do not depend on the path taken, so
+    # unless an engine is chosen they are found by the lazy dfa, which keeps no groups
+    def span_generator(self, codelines, labels, engine=None):
+        code = CodeText.of(codelines)
+        position_range = code.range
+        for match, _ in self.span_matches(code, labels, engine):
+            yield position_range(match)
+
+    # the (offset range, captures) pairs of the engine finding the spans, the captures are to be ignored
+    def span_matches(self, code, labels, engine=None):
+        self.check_engine(engine)
+        if engine == "unanchored":
+            return self.unanchored_match_generator(code, labels)
+        return self.anchored_match_generator(code, labels, self.engine_match_at("dfa" if engine is None else engine))
+
+    # the match_at of an engine searching from every begin offset, the backtrack search for any other
+    def engine_match_at(self, engine):
+        if engine == "pike":
+            return self.pike_match_at
+        elif engine == "dfa":
+            return self.dfa_match_at
+        elif engine == "compiled":
+            # falls back to the interpreted match_at when the automata is too large to generate
+            return self.compiled_match_at() or self.match_at
+        return self.match_at
+
+    # runs match_at from every begin offset the begin finder allows, moving past each match found
+    def anchored_match_generator(self, code, labels, match_at):
+        if len(code.lines) == 0:
+            return
+        text = code.text
+        next_begin = self.begin_finder(code, labels)
+        offset_last = len(text)
+        begin = next_begin(0)
+        while begin is not None:
+            match_end, captures = match_at(text, labels, begin)
+            if match_end is not None and match_end != begin:
+                yield (begin, match_end), captures
+                # avoid collisions
+                begin = None if match_end == offset_last else next_begin(match_end)
+                continue
+            if match_end is not None:
+                # an empty match, move on or we would find it again
+                yield (begin, match_end), captures
+            begin = code.next_begin(begin)
+            begin = None if begin == -1 else next_begin(begin)
+
+    # the matches of every rule of a pattern set in a single pass over the code, each rule with the greedy semantics
+    # of match_generator. next_begins holds the begin finder of every rule, the begin offsets of all the rules are
+    # visited in order and the rules waiting at an offset are run together. yields (rule, match range, groups)
+    # ordered by begin position and then by rule
+    def rules_match_generator(self, codelines, labels, next_begins):
+        code = CodeText.of(codelines)
+        if len(code.lines) == 0:
+            return
+        text = code.text
+        offset_last = len(text)
+        # begin offset -> the rules waiting to be tried there, and the heap of those offsets
+        waiting = {}
+        begins = []
+        for rule, next_begin in enumerate(next_begins):
+            self.wait_at(waiting, begins, next_begin(0), rule)
+        while len(begins) > 0:
+            begin = heappop(begins)
+            rules = waiting.pop(begin)
+            rules.sort()
+            matches = self.pike_rules_match_at(text, labels, begin, rules)
+            begin_next = code.next_begin(begin)
+            for rule in rules:
+                match_end, captures = matches.get(rule, (None, NO_CAPTURES))
+                if match_end is not None:
+                    yield rule, code.range((begin, match_end)), code.ranges(self.captures_to_groups(captures))
+                if match_end is not None and match_end != begin:
+                    # avoid collisions
+                    if match_end != offset_last:
+                        self.wait_at(waiting, begins, next_begins[rule](match_end), rule)
+                elif begin_next != -1:
+                    self.wait_at(waiting, begins, next_begins[rule](begin_next), rule)
+
+    @staticmethod
+    def wait_at(waiting, begins, begin, rule):
+        if begin is None:
+            return
+        if begin not in waiting:
+            waiting[begin] = []
+            heappush(begins, begin)
+        waiting[begin].append(rule)
+
+    # hands the search for match begins over to python's re engine, only for patterns without labels that never
+    # match the empty string and whose regex re searches without backtracking badly, see RegExParser.regex_to_nfa.
+    # the regex matches the same strings as the automata, so where it matches first a match of the automata begins.
+    # the engines then match from there, so the ends and groups are theirs
+    def delegate_to_re(self, regex):
+        self.re_pattern = re.compile(regex)
+
+    # begin finder for the re pattern, the first offset at or after the begin where the pattern matches. the last
+    # search is reused while the begins asked for stay between where it began and the match it found
+    def re_begin_finder(self, code):
+        search = self.re_pattern.search
+        text = code.text
+        # the offset last searched from (None before the first search) and the start found there, or None
+        searched = [None, None]
+
+        def next_begin(offset):
+            if searched[0] is None or offset < searched[0] or (searched[1] is not None and offset > searched[1]):
+                match = search(text, offset)
+                searched[0] = offset
+                searched[1] = None if match is None else match.start()
+            return searched[1]
+        return next_begin
+
+    def match_all(self, codelines: list, labels, engine=None):
+        return list(self.span_generator(codelines, labels, engine))
+
+    def match_first(self, codelines: list, labels, engine=None):
+        return next(self.span_generator(codelines, labels, engine))
 
     def get_key(self, val, d):
         for key, value in d.items():
@@ -225,39 +1167,28 @@ class GrammarAutomata:
                 return key
         return None
 
+    # replaces the groups of the matches, given by their position ranges, in the code lines
     @staticmethod
-    def flattened_range(range, codelines_length):
-        (range_begin_row, range_begin_col), (range_end_row, range_end_col) = range
-        sum_rows_before_begin = sum(codelines_length[: range_begin_row]) + range_begin_row
-        sum_rows_before_end = sum_rows_before_begin + sum(codelines_length[range_begin_row: range_end_row]) + \
-                              range_end_row - range_begin_row
-        return sum_rows_before_begin + range_begin_col, sum_rows_before_end + range_end_col
-
-    @staticmethod
-    def flattened_matches(codelines, match_groups_pairs):
-        codelines_lengths = [len(codeline) for codeline in codelines]
-        match_groups_pairs_flattened = []
-        for match, groups in match_groups_pairs:
-            match_flattened = GrammarAutomata.flattened_range(match, codelines_lengths)
-            groups_flattened = {group_id: [GrammarAutomata.flattened_range(group_range, codelines_lengths)
-                                           for group_range in group_ranges]
-                                for group_id, group_ranges in groups.items()}
-            match_groups_pairs_flattened.append((match_flattened, groups_flattened))
-        return match_groups_pairs_flattened
+    def replace_groups(codelines: list, match_groups_pairs, replace_list):
+        code = CodeText(codelines)
+        groups_list = [{group_index: [(code.offset(group_begin), code.offset(group_end))
+                                      for group_begin, group_end in group_ranges]
+                        for group_index, group_ranges in groups.items()} for _, groups in match_groups_pairs]
+        return GrammarAutomata.replace_offsets(code.text, groups_list, replace_list).split("\n")
 
+    # replaces the groups, given by their offset ranges, in the text
     @staticmethod
-    def replace_groups(codelines: list, match_groups_pairs, replace_list):
-        codelines_str = "\n".join(codelines)
-        match_groups_pairs_flattened = GrammarAutomata.flattened_matches(codelines, match_groups_pairs)
+    def replace_offsets(text, groups_list, replace_list):
         offset = 0
-        for _, groups in match_groups_pairs_flattened:
-            for group_index, group_matches in groups.items():
-                for (group_begin, group_end) in group_matches:
-                    # consider changing to a list of chars instead
-                    codelines_str = codelines_str[:offset + group_begin] + replace_list[group_index] + codelines_str[
-                                                                                                       offset + group_end:]
-                    offset += len(replace_list[group_index]) - (group_end - group_begin)
-        return codelines_str.split("\n")
+        for groups in groups_list:
+            # in the order of the text, the iterations of repeated groups may interleave
+            group_ranges = sorted(((group_range, group_index) for group_index, group_matches in groups.items()
+                                   for group_range in group_matches), key=lambda item: item[0][0])
+            for (group_begin, group_end), group_index in group_ranges:
+                # consider changing to a list of chars instead
+                text = text[:offset + group_begin] + replace_list[group_index] + text[offset + group_end:]
+                offset += len(replace_list[group_index]) - (group_end - group_begin)
+        return text
 
     # Assumes match0 starts before match1
     @staticmethod
@@ -283,12 +1214,149 @@ class GrammarAutomata:
                 return True
         return False
 
-    def replace_all(self, codelines: list, labels, replace_list):
-        match_groups_pairs = [(m, g) for (m, g) in self.match_generator(codelines, labels)]
-        return self.replace_groups(codelines, match_groups_pairs, replace_list)
+    def replace_all(self, codelines: list, labels, replace_list, engine=None, all_iterations=False):
+        code = CodeText.of(codelines)
+        groups_list = [groups for _, groups in self.offset_match_generator(code, labels, engine, all_iterations)]
+        return self.replace_offsets(code.text, groups_list, replace_list).split("\n")
 
-    def replace_first(self, codelines, labels, replace_list):
-        match, groups = next(self.match_generator(codelines, labels))[0]
+    def replace_first(self, codelines, labels, replace_list, engine=None):
+        match, groups = next(self.match_generator(codelines, labels, engine))
         return self.replace_groups(codelines, [(match, groups)], replace_list)
 
 
+class LazyDFA:
+    'deterministic automata built lazily from a GrammarAutomata, for finding where matches end without their groups.'
+    'a dfa state is a set of items, an item is an automata state reached at the current position or an (edge, prefix)'
+    'pair for a str or trie edge part of whose literal was read. transitions are computed on first use and cached,'
+    'over the characters of the code text plus label start events: at an offset where labels begin, the label edges of'
+    'the state send their destinations ahead to the labels\' ends, where they join the state read up to there.'
+    'the cache holds at most max_states states, when it is full it is flushed and rebuilt from the current state on'
+    def __init__(self, nfa, max_states=DFA_STATES_MAX):
+        self.nfa = nfa
+        self.max_states = max_states
+        self.flushes = 0
+        self.clear()
+
+    def flush(self):
+        self.clear()
+        self.flushes += 1
+
+    # drops every cached state and transition
+    def clear(self):
+        self.state_items = []
+        self.state_index = {}
+        # per state its transitions by character, whether it accepts and its label edges as (kind, destinations)
+        self.transitions = []
+        self.accepting = []
+        self.label_edges = []
+        self.state_first = None
+
+    def __len__(self):
+        return len(self.state_items)
+
+    # the id of the state holding the items, DFA_DEAD when there are none
+    def add_state(self, items):
+        if len(items) == 0:
+            return DFA_DEAD
+        state = self.state_index.get(items)
+        if state is not None:
+            return state
+        if len(self.state_items) >= self.max_states:
+            self.flush()
+        nfa = self.nfa
+        accepting = False
+        label_edges = {}
+        for item in items:
+            if isinstance(item, tuple):
+                continue
+            closure_edges, closure_accept = nfa.get_closure(item)
+            accepting = accepting or closure_accept is not None
+            for edge, _ in closure_edges:
+                if nfa.edge_kind[edge] < KIND_STR:
+                    label_edges.setdefault(nfa.edge_kind[edge], set()).add(nfa.edge_dst[edge])
+        state = len(self.state_items)
+        self.state_index[items] = state
+        self.state_items.append(items)
+        self.transitions.append({})
+        self.accepting.append(accepting)
+        self.label_edges.append(tuple((kind, frozenset(states)) for kind, states in sorted(label_edges.items())))
+        return state
+
+    # the state reached by reading char, DFA_DEAD when no item survives it
+    def next_state(self, state, char):
+        state_next = self.transitions[state].get(char)
+        if state_next is not None:
+            return state_next
+        nfa = self.nfa
+        items = set()
+        for item in self.state_items[state]:
+            if isinstance(item, tuple):
+                self.read_char(item[0], item[1] + char, items)
+                continue
+            for edge, _ in nfa.get_closure(item)[0]:
+                if nfa.edge_kind[edge] == KIND_STR or nfa.edge_kind[edge] == KIND_TRIE:
+                    self.read_char(edge, char, items)
+        flushes = self.flushes
+        state_next = self.add_state(frozenset(items))
+        # a flush leaves the id of the state read from invalid
+        if flushes == self.flushes:
+            self.transitions[state][char] = state_next
+        return state_next
+
+    # adds the item after reading prefix on the edge: its destination once the literal or a word of the trie is read,
+    # and the (edge, prefix) item while more of it can be read
+    def read_char(self, edge, prefix, items):
+        nfa = self.nfa
+        if nfa.edge_kind[edge] == KIND_STR:
+            literal = nfa.literals[nfa.edge_literal[edge]]
+            if literal == prefix:
+                items.add(nfa.edge_dst[edge])
+            elif literal.startswith(prefix):
+                items.add((edge, prefix))
+            return
+        node = nfa.tries[nfa.edge_literal[edge]][1]
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return
+        if TRIE_END in node:
+            items.add(nfa.edge_dst[edge])
+        if len(node) > (TRIE_END in node):
+            items.add((edge, prefix))
+
+    # the longest match end from the begin offset, or None. the state is advanced a character at a time along the
+    # text, the destinations of labels wait at the labels' ends and join the state there, or restart it once it died
+    def longest_match(self, text, labels, begin):
+        if self.state_first is None:
+            self.state_first = self.add_state(frozenset((0,)))
+        state = self.state_first
+        offset = begin
+        # offset -> automata states the labels ending there lead to, and the heap of those offsets
+        pending = {}
+        offsets = []
+        match_end = None
+        while True:
+            if len(offsets) > 0 and offsets[0] == offset:
+                heappop(offsets)
+                items = pending.pop(offset)
+                state = self.add_state(items if state == DFA_DEAD else items | self.state_items[state])
+            if self.accepting[state]:
+                match_end = offset
+            label_edges = self.label_edges[state]
+            if len(label_edges) > 0:
+                ends = labels.get(offset)
+                if ends is not None:
+                    for kind, states in label_edges:
+                        for end in ends[kind]:
+                            if end not in pending:
+                                pending[end] = states
+                                heappush(offsets, end)
+                            else:
+                                pending[end] = pending[end] | states
+            state = self.next_state(state, text[offset]) if offset < len(text) else DFA_DEAD
+            if state != DFA_DEAD:
+                offset += 1
+            elif len(offsets) > 0:
+                offset = offsets[0]
+            else:
+                return match_end
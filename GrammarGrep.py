@@ -1,25 +1,54 @@
 import ast
 import RegExParser
+from AhoCorasick import AhoCorasick
+from CodeText import CodeText
+from GrammarAutomata import DFA_STATES_MAX
+from LabelIndex import LabelIndex
+from PatternCache import PatternCache
+
+# compiled automatas shared by every GrammarGrep instance (and the command line tool)
+pattern_cache = PatternCache()
+# the labels handed to patterns that check none, so their code is never parsed
+NO_LABELS = LabelIndex()
 
 
 class GrammarGrep:
     def __init__(self, code: str = None):
+        self.source = None
         self.code = None
-        self.labels = None
+        self.code_text = None
+        self._labels = None
         if code is not None:
             self.load_code(code)
 
     'note that match is greedy - so it does not get every match, but instead the longest one from each initial position'
-    def match(self, regex):
-        nfa = RegExParser.regex_to_nfa(regex)
-        'nfa.display_graph()'
-        return nfa.match_all(self.code, self.labels)
+    def match(self, regex, engine=None):
+        return compile(regex).findall(self, engine)
 
-    def replace(self, regex, replace_list):
-        nfa = RegExParser.regex_to_nfa(regex)
-        return nfa.replace_all(self.code, self.labels, replace_list)
+    def replace(self, regex, replace_list, engine=None, all_iterations=False):
+        return compile(regex).sub(replace_list, self, engine, all_iterations)
 
+    'the code is parsed and labeled when its labels are first needed, so patterns whose required literals are missing'
+    'from the code never pay for the parse'
     def load_code(self, code: str):
+        self.source = code
+        self.code = code.splitlines()
+        self.code_text = CodeText(self.code)
+        self._labels = None
+
+    @property
+    def labels(self):
+        if self._labels is None and self.source is not None:
+            self._labels = self.label_code(self.source, self.code_text)
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        self._labels = labels
+
+    'labels the code, the label index is keyed by offsets into the code text'
+    @staticmethod
+    def label_code(code: str, text: CodeText = None):
         labels = {}
 
         class LabelVisitor(ast.NodeVisitor):
@@ -51,6 +80,168 @@ class GrammarGrep:
                     labels[key].append(value)
                 ast.NodeVisitor.generic_visit(self, node)
         parsed_code = ast.parse(code)
-        self.code = code.splitlines()
         LabelVisitor().visit(parsed_code)
-        self.labels = labels
+        return LabelIndex.from_labels(labels, CodeText(code.splitlines()) if text is None else text)
+
+
+class CompiledPattern:
+    'immutable compiled regex, can be run against any number of sources (code strings or loaded GrammarGreps)'
+    __slots__ = ("_pattern", "_nfa")
+
+    def __init__(self, pattern: str, nfa):
+        object.__setattr__(self, "_pattern", pattern)
+        object.__setattr__(self, "_nfa", nfa)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledPattern is immutable")
+
+    def __repr__(self):
+        return "CompiledPattern({!r})".format(self._pattern)
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    @property
+    def automata(self):
+        return self._nfa
+
+    @staticmethod
+    def _load(source):
+        if isinstance(source, GrammarGrep):
+            return source
+        return GrammarGrep(source)
+
+    'yields (match range, groups) pairs, groups maps a group index to the list of ranges it captured'
+    'engine is "backtrack" (memoized depth first search), "pike" (breadth first thompson simulation),'
+    '"unanchored" (a pike simulation running every begin position in a single forward scan), "compiled" (the'
+    'backtrack search generated as python source specialised to the pattern) or "dfa" (a lazily built dfa finds'
+    'the match ends, the groups of the matches only are found by the backtrack search within each match). "compiled"'
+    'and "dfa" give the same results as "backtrack". None picks the engine, "dfa". a repeated group captures its'
+    'last iteration, or every iteration in order when all_iterations is set'
+    def finditer(self, source, engine=None, all_iterations=False):
+        grep = self._load(source)
+        if not self._may_match(grep):
+            return iter(())
+        return self._nfa.match_generator(grep.code_text, self._labels(grep), engine, all_iterations)
+
+    # a source missing a required literal or a hit of the superset is skipped before it is parsed, and one missing a
+    # required label type right after it is labeled
+    def _may_match(self, grep):
+        return self._nfa.literals_occur(grep.code_text.text) and self._nfa.superset_occurs(grep.code_text.text) and \
+            self._nfa.label_types_occur(self._labels(grep))
+
+    def _labels(self, grep):
+        return grep.labels if self._nfa.uses_labels else NO_LABELS
+
+    'the match ranges finditer yields, found without tracking groups'
+    def spans(self, source, engine=None):
+        grep = self._load(source)
+        if not self._may_match(grep):
+            return iter(())
+        return self._nfa.span_generator(grep.code_text, self._labels(grep), engine)
+
+    def findall(self, source, engine=None):
+        return list(self.spans(source, engine))
+
+    def search(self, source, engine=None):
+        for m in self.spans(source, engine):
+            return m
+        return None
+
+    def count(self, source, engine=None):
+        return sum(1 for _ in self.spans(source, engine))
+
+    def sub(self, replace_list, source, engine=None, all_iterations=False):
+        grep = self._load(source)
+        if not self._may_match(grep):
+            return self._nfa.replace_groups(grep.code, [], replace_list)
+        return self._nfa.replace_all(grep.code_text, self._labels(grep), replace_list, engine, all_iterations)
+
+
+class PatternSet:
+    'immutable set of regexes (rules) compiled into one automata and matched together in a single pass per source,'
+    'a rule id is the index of its regex. every rule gets the matches compile(regex) finds with the "pike" engine'
+    __slots__ = ("_patterns", "_nfa", "_rule_nfas", "_prefilter", "_rule_words", "_rule_skip_words")
+
+    def __init__(self, patterns):
+        patterns = tuple(patterns)
+        object.__setattr__(self, "_patterns", patterns)
+        # the automata of every rule on its own, for the hints that skip begin positions. they are kept out of the
+        # pattern cache, a large set would evict every pattern cached by the rest of the process
+        nfa, rule_nfas = RegExParser.regexes_to_nfas(patterns)
+        object.__setattr__(self, "_nfa", nfa)
+        object.__setattr__(self, "_rule_nfas", rule_nfas)
+        # the literals every match of a rule contains are found for all the rules in one pass, a rule only runs
+        # when all of its literals occur and only from the begin positions its skip literal's occurrences allow
+        words = {}
+        rule_words = []
+        for nfa in rule_nfas:
+            rule_words.append(tuple(words.setdefault(literal, len(words)) for literal in nfa.required_literals))
+        object.__setattr__(self, "_prefilter", AhoCorasick(words))
+        object.__setattr__(self, "_rule_words", tuple(rule_words))
+        object.__setattr__(self, "_rule_skip_words", tuple(None if nfa.skip_literal is None else
+                                                           words[nfa.skip_literal[0]] for nfa in rule_nfas))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PatternSet is immutable")
+
+    def __repr__(self):
+        return "PatternSet({!r})".format(list(self._patterns))
+
+    def __len__(self):
+        return len(self._patterns)
+
+    @property
+    def patterns(self):
+        return self._patterns
+
+    @property
+    def automata(self):
+        return self._nfa
+
+    'yields (rule id, match range, groups) triples ordered by the match begin and then by the rule id'
+    def finditer(self, source):
+        grep = CompiledPattern._load(source)
+        occurrences = self._prefilter.find_all(grep.code_text.text)
+        rules = [rule for rule in self._literal_candidates(occurrences)
+                 if self._rule_nfas[rule].superset_occurs(grep.code_text.text)]
+        # the source is only parsed when some rule's literals and superset all occur in it
+        if len(rules) == 0:
+            return iter(())
+        labels = grep.labels if any(self._rule_nfas[rule].uses_labels for rule in rules) else NO_LABELS
+        rules = {rule for rule in rules if self._rule_nfas[rule].label_types_occur(labels)}
+        next_begins = [self._begin_finder(rule, grep, labels, occurrences) if rule in rules else
+                       lambda offset: None for rule in range(len(self._patterns))]
+        return self._nfa.rules_match_generator(grep.code_text, labels, next_begins)
+
+    'the rules that can match the source judging by their required literals, found without parsing the source'
+    def candidates(self, source):
+        grep = CompiledPattern._load(source)
+        return self._literal_candidates(self._prefilter.find_all(grep.code_text.text))
+
+    def _literal_candidates(self, occurrences):
+        return [rule for rule, words in enumerate(self._rule_words)
+                if all(len(occurrences[word]) > 0 for word in words)]
+
+    def _begin_finder(self, rule, grep, labels, occurrences):
+        skip_word = self._rule_skip_words[rule]
+        return self._rule_nfas[rule].begin_finder(grep.code_text, labels,
+                                                  None if skip_word is None else occurrences[skip_word])
+
+    'the match ranges of every rule, as a list indexed by rule id'
+    def findall(self, source):
+        matches = [[] for _ in self._patterns]
+        for rule, m, _ in self.finditer(source):
+            matches[rule].append(m)
+        return matches
+
+
+'dfa_states_max caps the states the lazy dfa of the pattern caches before it is flushed, patterns compiled with'
+'different caps get automatas of their own'
+def compile(regex: str, dfa_states_max=DFA_STATES_MAX):
+    return CompiledPattern(regex, pattern_cache.get(regex, dfa_states_max))
+
+
+def compile_set(regexes):
+    return PatternSet(regexes)
@@ -0,0 +1,38 @@
+LABEL_TYPES = ("id_type", "stmt_type", "expr_type", "str_type", "num_type")
+# interned integer code of every label type, the index into the per offset tuples of a LabelIndex
+LABEL_CODES = {label_type: code for code, label_type in enumerate(LABEL_TYPES)}
+NO_ENDS = ()
+
+
+class LabelIndex(dict):
+    'maps an offset into the code text (see CodeText) to a tuple holding, for every label type code, the end offsets'
+    'of the labels of that type beginning there. the tuples are built once so lookups while matching never allocate'
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._starts = {}
+
+    'labels maps a (lineno, col_offset) position to a list of (type, end_lineno, end_col_offset), code is the'
+    'CodeText the positions are turned into offsets of. columns count utf-8 bytes, as the ast module gives them'
+    @staticmethod
+    def from_labels(labels: dict, code):
+        index = LabelIndex()
+        for (lineno, col_offset), list_types in labels.items():
+            ends = [[] for _ in LABEL_TYPES]
+            for (label_type, end_lineno, end_col_offset) in list_types:
+                ends[LABEL_CODES[label_type]].append(code.byte_offset((end_lineno, end_col_offset)))
+            # a node and its only child may share both ends, one of them is enough
+            index[code.byte_offset((lineno, col_offset))] = tuple(
+                tuple(dict.fromkeys(ends_type)) if len(ends_type) > 0 else NO_ENDS for ends_type in ends)
+        return index
+
+    # sorted offsets where a label of one of the given types begins, computed once per set of types
+    def get_starts(self, label_types: frozenset):
+        starts = self._starts.get(label_types)
+        if starts is None:
+            codes = [LABEL_CODES[label_type] for label_type in label_types]
+            starts = sorted(offset for offset, ends in self.items() if any(len(ends[code]) > 0 for code in codes))
+            self._starts[label_types] = starts
+        return starts
+
+    def has_type(self, label_type):
+        return len(self.get_starts(frozenset((label_type,)))) > 0
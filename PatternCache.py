@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+import RegExParser
+from GrammarAutomata import DFA_STATES_MAX
+
+
+class PatternCache:
+    'bounded, thread safe LRU cache of compiled automata keyed by the pattern text and the state cap of their lazy dfa'
+    def __init__(self, maxsize=128):
+        if maxsize < 0:
+            raise ValueError("cache size must be non-negative")
+        self._maxsize = maxsize
+        self._automatas = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        if maxsize < 0:
+            raise ValueError("cache size must be non-negative")
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def get(self, regex: str, dfa_states_max=DFA_STATES_MAX):
+        key = (regex, dfa_states_max)
+        with self._lock:
+            nfa = self._automatas.get(key)
+            if nfa is not None:
+                self._automatas.move_to_end(key)
+                self.hits += 1
+                return nfa
+            self.misses += 1
+        # compile outside of the lock so a slow pattern does not block other threads, if two threads miss on
+        # the same pattern both compile it and the later one wins, which is harmless since automatas never change
+        # once built. their lazily built caches are either filled with the same values by any thread or, for the
+        # lazy dfa, kept per thread
+        nfa = RegExParser.regex_to_nfa(regex, dfa_states_max)
+        with self._lock:
+            if self._maxsize > 0:
+                self._automatas[key] = nfa
+                self._automatas.move_to_end(key)
+                self._evict()
+        return nfa
+
+    def _evict(self):
+        while len(self._automatas) > self._maxsize:
+            self._automatas.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._automatas.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "size": len(self._automatas), "maxsize": self._maxsize}
+
+    def __len__(self):
+        return len(self._automatas)
+
+    # whether the regex is cached with the given state cap
+    def contains(self, regex, dfa_states_max=DFA_STATES_MAX):
+        return (regex, dfa_states_max) in self._automatas
+
+    def __contains__(self, regex):
+        return self.contains(regex)
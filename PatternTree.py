@@ -0,0 +1,241 @@
+import os
+
+'''
+Pattern syntax tree, built by RegExParser and optimized before the automata is built.
+Nodes are (kind, value, children) tuples:
+    ("str", literal, ())
+    ("trie", words, ()) NOTE: matches any of the words, kept in priority order
+    ("meta", label type, ())
+    ("group", group index, (child,))
+    ("concat", None, children)
+    ("or", None, alternatives) NOTE: alternatives are kept in priority order
+    ("star", None, (child,)), ("plus", None, (child,)), ("question", None, (child,))
+'''
+
+REPEAT_KINDS = ("star", "plus", "question")
+
+# the fewest words a run of literal alternatives needs to be compiled into a trie
+TRIE_MIN_WORDS = 4
+
+# (outer, inner) repeat kinds to the single repeat they are equivalent to
+REPEAT_NESTING = {
+    ("star", "star"): "star", ("star", "plus"): "star", ("star", "question"): "star",
+    ("plus", "star"): "star", ("plus", "plus"): "plus", ("plus", "question"): "star",
+    ("question", "star"): "star", ("question", "plus"): "star", ("question", "question"): "question",
+}
+
+
+def make_str(literal):
+    return "str", literal, ()
+
+
+def make_concat(children):
+    if len(children) == 1:
+        return children[0]
+    return "concat", None, tuple(children)
+
+
+def make_or(alternatives):
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return "or", None, tuple(alternatives)
+
+
+# rebuilds the tree bottom up, calling rewrite on every node once its children were rewritten. iterative since
+# patterns can nest deeper than the recursion limit
+def transform(tree, rewrite):
+    stack = [(tree, False)]
+    results = []
+    while len(stack) > 0:
+        node, children_done = stack.pop()
+        kind, value, children = node
+        if not children_done:
+            stack.append((node, True))
+            stack.extend([(child, False) for child in reversed(children)])
+            continue
+        children_count = len(children)
+        if children_count > 0:
+            children = tuple(results[-children_count:])
+            del results[-children_count:]
+        results.append(rewrite((kind, value, children)))
+    return results[0]
+
+
+def has_groups(tree):
+    stack = [tree]
+    while len(stack) > 0:
+        kind, _, children = stack.pop()
+        if kind == "group":
+            return True
+        stack.extend(children)
+    return False
+
+
+def leading_literal(node):
+    kind, value, children = node
+    if kind == "str":
+        return value
+    if kind == "concat" and children[0][0] == "str":
+        return children[0][1]
+    return None
+
+
+# the node without the first length characters of its leading literal, None if nothing is left
+def strip_leading_literal(node, length):
+    kind, value, children = node
+    if kind == "str":
+        return make_str(value[length:]) if length < len(value) else None
+    literal = children[0][1]
+    if length < len(literal):
+        return make_concat((make_str(literal[length:]),) + children[1:])
+    return make_concat(children[1:])
+
+
+# the words a literal or trie node matches, None for other nodes
+def node_words(node):
+    kind, value, _ = node
+    if kind == "str":
+        return value,
+    if kind == "trie":
+        return value
+    return None
+
+
+# splits an alternative into the words it begins with and the sequence after them, None if it does not begin with a
+# literal or a trie
+def split_words(node):
+    words = node_words(node)
+    if words is not None:
+        return words, ()
+    kind, _, children = node
+    if kind == "concat":
+        words = node_words(children[0])
+        if words is not None:
+            return words, children[1:]
+    return None
+
+
+# the words in order, a repeated word keeps its first (highest priority) place
+def make_trie(words):
+    return "trie", tuple(dict.fromkeys(words)), ()
+
+
+# an integer equal for equal trees and only for them, so comparing deep trees does not recurse. keys maps every
+# (kind, value, child keys) to its key and the id of every tree keyed so far to the tree and its key, the remainders
+# of nested prefixes share their sequences and each is walked once
+def tree_key(tree, keys):
+    keyed = keys.get(id(tree))
+    if keyed is None:
+        keyed = keys[id(tree)] = tree, transform(tree, lambda node: keys.setdefault(node, len(keys)))
+    return keyed[1]
+
+
+# replaces runs of consecutive alternatives that begin with a literal (or a trie) and continue with the same sequence
+# by a trie followed by that sequence, so all the words are decided by one walk over the characters. the sequences
+# are equal so they hold no groups and sharing them loses no captures
+def merge_tries(alternatives, keys):
+    merged = []
+    i = 0
+    while i < len(alternatives):
+        split = split_words(alternatives[i])
+        j = i + 1
+        words = []
+        if split is not None:
+            words.extend(split[0])
+            sequence_key = tuple(tree_key(node, keys) for node in split[1])
+            while j < len(alternatives):
+                split_next = split_words(alternatives[j])
+                if split_next is None or len(split_next[1]) != len(split[1]) or \
+                        tuple(tree_key(node, keys) for node in split_next[1]) != sequence_key:
+                    break
+                words.extend(split_next[0])
+                j += 1
+        if j - i == 1 or len(words) < TRIE_MIN_WORDS:
+            merged.extend(alternatives[i:j])
+        else:
+            merged.append(optimize_concat((make_trie(words),) + split[1]))
+        i = j
+    return merged
+
+
+# flattens nested sequences and merges adjacent literals, groups capture so their sequences are left in place
+def optimize_concat(children):
+    flattened = []
+    for child in children:
+        flattened.extend(child[2] if child[0] == "concat" else (child,))
+    merged = []
+    for child in flattened:
+        if child[0] == "str" and len(merged) > 0 and merged[-1][0] == "str":
+            merged[-1] = make_str(merged[-1][1] + child[1])
+        else:
+            merged.append(child)
+    return make_concat(merged)
+
+
+# flattens nested alternations and compiles large literal alternations into tries
+def flatten_or(alternatives, keys):
+    flattened = []
+    for alternative in alternatives:
+        flattened.extend(alternative[2] if alternative[0] == "or" else (alternative,))
+    return merge_tries(flattened, keys)
+
+
+# flattens nested alternations, compiles large literal alternations into tries and factors the common literal prefix
+# out of runs of consecutive alternatives, the priority order of the alternatives is kept. the alternatives left after
+# a prefix are factored in turn, with an explicit stack since prefixes can nest as deep as the alternation is long
+def optimize_or(alternatives):
+    keys = {}
+    # a frame per alternation being factored: [its alternatives, the next one to factor, the factored ones, the prefix
+    # it follows (None for the outermost)]
+    frames = [[flatten_or(alternatives, keys), 0, [], None]]
+    while True:
+        frame = frames[-1]
+        flattened, i, factored, _ = frame
+        if i == len(flattened):
+            frames.pop()
+            if len(frames) == 0:
+                return make_or(factored)
+            frames[-1][2].append(optimize_concat((make_str(frame[3]), make_or(factored))))
+            continue
+        literal = leading_literal(flattened[i])
+        j = i + 1
+        if literal is not None:
+            while j < len(flattened) and leading_literal(flattened[j]) is not None and \
+                    leading_literal(flattened[j])[0] == literal[0]:
+                j += 1
+        frame[1] = j
+        if j - i == 1:
+            factored.append(flattened[i])
+            continue
+        run = flattened[i:j]
+        prefix = os.path.commonprefix([leading_literal(alternative) for alternative in run])
+        # every alternative has to keep something after the prefix, the empty alternative does not exist
+        prefix_max = min(len(leading_literal(alternative)) - (alternative[0] == "str") for alternative in run)
+        prefix = prefix[:prefix_max]
+        if len(prefix) == 0:
+            factored.extend(run)
+        else:
+            remainders = [strip_leading_literal(alternative, len(prefix)) for alternative in run]
+            frames.append([flatten_or(remainders, keys), 0, [], prefix])
+
+
+def optimize_repeat(kind, child):
+    # nested repeats collapse into one, unless the inner one holds groups whose captures depend on the nesting
+    if child[0] in REPEAT_KINDS and not has_groups(child):
+        return REPEAT_NESTING[(kind, child[0])], None, child[2]
+    return kind, None, (child,)
+
+
+def optimize_node(node):
+    kind, value, children = node
+    if kind == "concat":
+        return optimize_concat(children)
+    if kind == "or":
+        return optimize_or(children)
+    if kind in REPEAT_KINDS:
+        return optimize_repeat(kind, children[0])
+    return node
+
+
+def optimize(tree):
+    return transform(tree, optimize_node)
@@ -1,4 +1,7 @@
-from GrammarAutomata import GrammarAutomata
+import re
+
+import PatternTree
+from GrammarAutomata import GrammarAutomata, DFA_STATES_MAX
 
 '''
 Production Rules:
@@ -25,89 +28,273 @@ Examples:
 '''
 
 
-def get_closing_paren(regex: str, paren_open_idx):
-    i = regex.find(";", paren_open_idx)
-    counter = 1
-    while True:
-        if regex[i + 1] == "(":
-            counter += 1
-        elif regex[i + 1] == ")":
-            counter -= 1
-        if counter == 0:
-            return i + 2
-        i = regex.find(";", i + 1)
-        if i == -1:
-            raise RuntimeError("Regular expression's parentheses are unbalanced")
-
-def get_groups(regex: str):
-    groups = {}
-    i_begin = regex.find(";(", 0)
-    while i_begin != -1:
-        i_end = get_closing_paren(regex, i_begin+1)
-        groups[i_begin] = (i_end, len(groups))
-        i_begin = regex.find(";(", i_begin + 2)
-    return groups
-
-
-def regex_to_nfa_aux(regex: str, groups, i_begin, i_end):
-    nfa = None
-    i_curr = i_begin
-    while i_curr < i_end:
-        meta_idx = regex.find(";", i_curr, i_end)
-        if meta_idx == -1:
-            nfa_step = GrammarAutomata.create_automata_matching(regex[i_curr:i_end])
-            nfa = GrammarAutomata.create_automata_concat(nfa, nfa_step)
-            return nfa
+# meta labels in the order they are tried, so ;stmt is not read as ;str followed by "mt"
+META_LABELS = (("id", "id_type"), ("stmt", "stmt_type"), ("expr", "expr_type"), ("str", "str_type"),
+               ("num", "num_type"))
+META_OPERATORS = "()|*+?"
+REPEAT_OPERATORS = {"star": "*", "plus": "+", "question": "?"}
+# regexes matching at least the source text of every label of a type. the text of ;expr, ;stmt and ;str labels is
+# left unconstrained, on newer pythons even the constants inside an f-string are str labels and have no quotes
+META_SUPERSETS = {"id_type": r"\w+", "num_type": r"[\d.][\w.+-]*"}
+# stands for any text in the sequence built by tree_to_superset
+WILDCARD = None
+
+
+def compile_error(reason, offset):
+    return RuntimeError("Could not compile regular expression, {} at offset {}".format(reason, offset))
+
 
+# splits the regex into (kind, value, offset) tokens in a single pass. kinds are "str" with the literal as value,
+# "meta" with the label type as value, or one of the meta operators
+def tokenize(regex: str):
+    tokens = []
+    i_curr = 0
+    while i_curr < len(regex):
+        meta_idx = regex.find(";", i_curr)
+        if meta_idx == -1:
+            meta_idx = len(regex)
         if meta_idx > i_curr:
-            nfa_step = GrammarAutomata.create_automata_matching(regex[i_curr:meta_idx])
-            nfa = GrammarAutomata.create_automata_concat(nfa, nfa_step)
-
-        if regex[meta_idx + 1] == "(":
-            idx_close, idx_group = groups[meta_idx]
-            nfa_step = regex_to_nfa_aux(regex, groups, meta_idx + 2, idx_close - 2)
-            nfa_step.add_group(idx_group)
-            i_curr = idx_close
-            nfa = GrammarAutomata.create_automata_concat(nfa, nfa_step)
-        elif regex[meta_idx + 1] == "|":
-            nfa_l = nfa
-            nfa_r = regex_to_nfa_aux(regex, groups, meta_idx + 2, i_end)
-            nfa = GrammarAutomata.create_automata_or(nfa_l, nfa_r)
-            return nfa
-        elif regex[meta_idx + 1] == "*":
-            nfa = GrammarAutomata.create_automata_star(nfa)
-            i_curr = meta_idx + 2
-        elif regex[meta_idx + 1] == "+":
-            nfa = GrammarAutomata.create_automata_plus(nfa)
-            i_curr = meta_idx + 2
-        elif regex[meta_idx + 1] == "?":
-            nfa = GrammarAutomata.create_automata_question(nfa)
+            tokens.append(("str", regex[i_curr:meta_idx], i_curr))
+        if meta_idx == len(regex):
+            break
+        if meta_idx + 1 < len(regex) and regex[meta_idx + 1] in META_OPERATORS:
+            tokens.append((regex[meta_idx + 1], None, meta_idx))
             i_curr = meta_idx + 2
-        elif regex[meta_idx + 1:].startswith("id"):
-            nfa_step = GrammarAutomata.create_automata_meta("id_type")
-            nfa = GrammarAutomata.create_automata_concat(nfa, nfa_step)
-            i_curr = meta_idx + 1 + 2
-        elif regex[meta_idx + 1:].startswith("stmt"):
-            nfa_step = GrammarAutomata.create_automata_meta("stmt_type")
-            nfa = GrammarAutomata.create_automata_concat(nfa, nfa_step)
-            i_curr = meta_idx + 1 + 4
-        elif regex[meta_idx + 1:].startswith("expr"):
-            nfa_step = GrammarAutomata.create_automata_meta("expr_type")
-            nfa = GrammarAutomata.create_automata_concat(nfa, nfa_step)
-            i_curr = meta_idx + 1 + 4
-        elif regex[meta_idx + 1:].startswith("str"):
-            nfa_step = GrammarAutomata.create_automata_meta("str_type")
-            nfa = GrammarAutomata.create_automata_concat(nfa, nfa_step)
-            i_curr = meta_idx + 1 + 3
-        elif regex[meta_idx + 1:].startswith("num"):
-            nfa_step = GrammarAutomata.create_automata_meta("num_type")
-            nfa = GrammarAutomata.create_automata_concat(nfa, nfa_step)
-            i_curr = meta_idx + 1 + 3
+            continue
+        for meta_name, meta_type in META_LABELS:
+            if regex.startswith(meta_name, meta_idx + 1):
+                tokens.append(("meta", meta_type, meta_idx))
+                i_curr = meta_idx + 1 + len(meta_name)
+                break
         else:
-            raise RuntimeError("Could not compile regular expression")
+            raise compile_error("unknown meta character", meta_idx)
+    return tokens
+
+
+# closes the alternatives of a group (or of the whole regex)
+def close_alternatives(frame, offset):
+    _, _, alternatives, sequence = frame
+    if len(sequence) == 0:
+        raise compile_error("empty alternative", offset)
+    return PatternTree.make_or(alternatives + [PatternTree.make_concat(sequence)])
+
+
+# builds the regex's syntax tree from its tokens with an explicit stack instead of recursion, so neither long
+# alternations nor deep nesting are limited by the interpreter's recursion limit. groups are numbered by the order
+# of their ;( in the regex
+def tokens_to_tree(tokens, regex_length):
+    # a frame per open group: [group index, offset of its ;(, finished alternatives, current alternative]
+    frames = [[None, 0, [], []]]
+    group_count = 0
+    for kind, value, offset in tokens:
+        frame = frames[-1]
+        if kind == "str" or kind == "meta":
+            frame[3].append((kind, value, ()))
+        elif kind == "(":
+            frames.append([group_count, offset, [], []])
+            group_count += 1
+        elif kind == ")":
+            if len(frames) == 1:
+                raise compile_error("unbalanced ;)", offset)
+            node = close_alternatives(frame, offset)
+            frames.pop()
+            frames[-1][3].append(("group", frame[0], (node,)))
+        elif kind == "|":
+            if len(frame[3]) == 0:
+                raise compile_error("empty alternative", offset)
+            frame[2].append(PatternTree.make_concat(frame[3]))
+            frame[3] = []
+        else:
+            # a postfix operator repeats everything before it in the current alternative
+            if len(frame[3]) == 0:
+                raise compile_error("nothing to repeat", offset)
+            repeat_kind = {"*": "star", "+": "plus", "?": "question"}[kind]
+            frame[3] = [(repeat_kind, None, (PatternTree.make_concat(frame[3]),))]
+    if len(frames) > 1:
+        raise compile_error("unbalanced ;(", frames[-1][1])
+    return close_alternatives(frames[0], regex_length)
+
+
+# appends the tree's automata to nfa and returns its fragment
+def tree_to_nfa(nfa: GrammarAutomata, tree):
+    def emit(node):
+        kind, value, children = node
+        if kind == "str":
+            return nfa.add_matching(value)
+        elif kind == "meta":
+            return nfa.add_meta(value)
+        elif kind == "trie":
+            return nfa.add_trie(value)
+        elif kind == "group":
+            nfa.add_group(value, children[0])
+            return children[0]
+        elif kind == "concat":
+            fragment = None
+            for child in children:
+                fragment = nfa.add_concat(fragment, child)
+            return fragment
+        elif kind == "or":
+            return nfa.add_alternatives(children)
+        elif kind == "star":
+            return nfa.add_star(children[0])
+        elif kind == "plus":
+            return nfa.add_plus(children[0])
+        return nfa.add_question(children[0])
+    return PatternTree.transform(tree, emit)
+
+
+# translates a tree without labels to a python regex matching the same strings, groups do not capture. returns None
+# when the tree has a label
+def tree_to_re(tree):
+    def emit(node):
+        kind, value, children = node
+        if kind == "meta" or None in children:
+            return None
+        if kind == "str":
+            return re.escape(value)
+        elif kind == "trie":
+            return "(?:" + "|".join(re.escape(word) for word in value) + ")"
+        elif kind == "group":
+            return "(?:" + children[0] + ")"
+        elif kind == "concat":
+            return "".join(children)
+        elif kind == "or":
+            return "(?:" + "|".join(children) + ")"
+        return "(?:" + children[0] + ")" + REPEAT_OPERATORS[kind]
+    return PatternTree.transform(tree, emit)
+
+
+# over approximates a tree with labels by a sequence of python regexes and wildcards standing for any text, every
+# match of the tree is text holding matches of the regexes in order. alternations over labels and repeats of anything
+# but a single string become wildcards as a whole, and a wildcard splits a regex before it would hold a second part
+# matching in several ways, so searching the regexes never backtracks badly
+def tree_to_superset(tree):
+    # every node becomes its sequence of wildcards and [regex, whether it varies] items, a regex varies when it holds
+    # a label, an alternation or a repeat and so matches more than a single string
+    def emit(node):
+        kind, value, children = node
+        if kind == "meta":
+            superset = META_SUPERSETS.get(value, WILDCARD)
+            return [WILDCARD if superset is WILDCARD else [superset, True]]
+        elif kind == "str" or kind == "trie":
+            return [[tree_to_re(node), kind == "trie"]]
+        elif kind == "group":
+            return children[0]
+        elif kind == "concat":
+            sequence = []
+            for child_sequence in children:
+                for item in child_sequence:
+                    if len(sequence) == 0 or (item is WILDCARD) != (sequence[-1] is WILDCARD):
+                        sequence.append(item if item is WILDCARD else list(item))
+                    elif item is not WILDCARD:
+                        if sequence[-1][1] and item[1]:
+                            sequence.extend([WILDCARD, list(item)])
+                        else:
+                            sequence[-1] = [sequence[-1][0] + item[0], sequence[-1][1] or item[1]]
+            return sequence
+        elif kind == "or":
+            if all(len(sequence) == 1 and sequence[0] is not WILDCARD for sequence in children):
+                return [["(?:" + "|".join(sequence[0][0] for sequence in children) + ")", True]]
+            return [WILDCARD]
+        sequence = children[0]
+        if len(sequence) > 1 or sequence[0] is WILDCARD or sequence[0][1]:
+            return [WILDCARD]
+        return [["(?:" + sequence[0][0] + ")" + REPEAT_OPERATORS[kind], True]]
+    return [item if item is WILDCARD else item[0] for item in PatternTree.transform(tree, emit)]
+
+
+# the string the node matches when it holds literals and groups only, None otherwise
+def fixed_string(node):
+    pieces = []
+    stack = [node]
+    while len(stack) > 0:
+        kind, value, children = stack.pop()
+        if kind == "str":
+            pieces.append(value)
+        elif kind not in ("group", "concat"):
+            return None
+        stack.extend(reversed(children))
+    return "".join(pieces)
+
+
+# whether no word is a prefix of another, so at most one of them matches at any offset. a word is a prefix of another
+# only if it is a prefix of the word right after it in sorted order
+def is_prefix_free(words):
+    words = sorted(words)
+    return not any(words[i + 1].startswith(words[i]) for i in range(len(words) - 1))
+
+
+# whether the re module searches the tree in time linear in the text per begin. it backtracks exponentially when it
+# has to choose between ways of matching the same text again and again, so only the iterations of a single loop over
+# a single string are left for it to choose. optional parts are a choice with the empty string and alternatives have
+# to be single strings none of which is a prefix of another
+def re_searches_safely(tree):
+    loops = 0
+    stack = [tree]
+    while len(stack) > 0:
+        kind, value, children = stack.pop()
+        if kind == "meta" or kind == "question":
+            return False
+        if kind == "star" or kind == "plus":
+            loops += 1
+            if loops > 1 or fixed_string(children[0]) is None:
+                return False
+        elif kind == "or" or kind == "trie":
+            words = value if kind == "trie" else [fixed_string(child) for child in children]
+            if None in words or not is_prefix_free(words):
+                return False
+        else:
+            stack.extend(children)
+    return True
+
+
+def regex_to_tree(regex: str):
+    return PatternTree.optimize(tokens_to_tree(tokenize(regex), len(regex)))
+
+
+def regex_to_nfa(regex: str, dfa_states_max=DFA_STATES_MAX):
+    return tree_to_pattern_nfa(regex_to_tree(regex), dfa_states_max)
+
+
+# the automata of a single pattern with its search hints, dfa_states_max caps the states of its lazy dfa
+def tree_to_pattern_nfa(tree, dfa_states_max=DFA_STATES_MAX):
+    nfa = GrammarAutomata(dfa_states_max)
+    nfa.finish(tree_to_nfa(nfa, tree))
+    # the re module finds where the matches of patterns of literals only begin, except for the nullable ones, which
+    # match everywhere, and the ones it could backtrack badly on, whose begins the automata's own finders find
+    if not nfa.uses_labels and not nfa.is_nullable() and re_searches_safely(tree):
+        try:
+            nfa.delegate_to_re(tree_to_re(tree))
+        except (re.error, RecursionError):
+            # too deeply nested for the re module, the automata matches it
+            pass
+    elif not nfa.is_nullable():
+        # a superset of the pattern the re module searches for before the code is parsed
+        try:
+            nfa.set_superset(tree_to_superset(tree))
+        except (re.error, RecursionError):
+            pass
+    return nfa
+
+
+# the automata of a pattern set, the rules are the regexes in order
+def regexes_to_nfa(regexes):
+    return trees_to_nfa([regex_to_tree(regex) for regex in regexes])
+
+
+def trees_to_nfa(trees):
+    nfa = GrammarAutomata()
+    rules = []
+    for tree in trees:
+        group_count = len(nfa.groups)
+        fragment = tree_to_nfa(nfa, tree)
+        rules.append((fragment, len(nfa.groups) - group_count))
+    nfa.finish_set(rules)
     return nfa
 
 
-def regex_to_nfa(regex: str):
-    groups = get_groups(regex)
-    return regex_to_nfa_aux(regex, groups, 0, len(regex))
+# the automata of a pattern set and the automata of every rule on its own, for the rules' search hints. every regex
+# is parsed once for both
+def regexes_to_nfas(regexes):
+    trees = [regex_to_tree(regex) for regex in regexes]
+    return trees_to_nfa(trees), tuple(tree_to_pattern_nfa(tree) for tree in trees)
@@ -1,6 +1,17 @@
+import os
+import threading
+import time
 import unittest
+from unittest import mock
 
+import GrammarGrep as gg
+import RegExParser
+from LabelIndex import LabelIndex, LABEL_CODES, NO_ENDS
+from GrammarAutomata import GrammarAutomata, LazyDFA, KIND_EPSILON, DFA_STATES_MAX
 from GrammarGrep import GrammarGrep
+from PatternCache import PatternCache
+from AhoCorasick import AhoCorasick
+from CodeText import CodeText
 
 code_simple_function = \
     "def f(x, y):\n" \
@@ -22,6 +33,20 @@ code_asserts = \
     "   assertEqual(2111, name)\n" \
     "   assertEqual(2, 2)"
 
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "benchmarks.py")) as f:
+    code_nested_ifs = f.read().split("'''")[3]
+
+
+class CountingLabels(LabelIndex):
+    'labels index that counts lookups, a measure of the work done by the matching engine'
+    def __init__(self, labels):
+        super().__init__(labels)
+        self.lookups = 0
+
+    def get(self, key, default=None):
+        self.lookups += 1
+        return super().get(key, default)
+
 
 # note: match does not return all matches, but instead the longest ones starting at each initial position
 
@@ -129,13 +154,767 @@ class TestGrammerGrep(unittest.TestCase):
         grep = GrammarGrep("123123123")
         self.assertEqual(grep.replace(";(123;)", ['321']), ["321321321"])
 
-    '''def test_replace_multiple_occurrences_of_single_group_in_match(self):
+    def test_replace_multiple_occurrences_of_single_group_in_match(self):
         grep = GrammarGrep("123123123")
-        self.assertEqual(grep.replace(";(123;);*", ['321']), ["321321321"])'''
+        self.assertEqual(grep.replace(";(123;);*", ['321'], all_iterations=True), ["321321321"])
+        self.assertEqual(grep.replace(";(123;);*", ['321']), ["123123321"])
 
     def test_replace_longest_match(self):
         grep = GrammarGrep("AAAAAAAAAAA")
         self.assertEqual(grep.replace(";(A;*;)", ['B']), ["B"])
 
+class TestMatchEngine(unittest.TestCase):
+
+    def count_lookups(self, regex, code):
+        grep = GrammarGrep(code)
+        grep.labels = CountingLabels(grep.labels)
+        matches = grep.match(regex, engine="backtrack")
+        return len(matches), grep.labels.lookups
+
+    def test_star_over_nullable_terminates(self):
+        grep = GrammarGrep(code_number)
+        self.assertEqual(grep.match("2;(;(1;?;);*;)"), [((0, 0), (0, 2)), ((0, 2), (0, 5)), ((0, 5), (0, 6))])
+
+    def test_longest_alternative_wins(self):
+        grep = GrammarGrep(code_number)
+        self.assertEqual(grep.match("2;|21;|211"), [((0, 0), (0, 2)), ((0, 2), (0, 5)), ((0, 5), (0, 6))])
+
+    def test_nested_stars_linear_in_code_size(self):
+        regex = "if ;(;(;expr;| ;);*;);*:"
+        matches_single, lookups_single = self.count_lookups(regex, code_nested_ifs)
+        matches_double, lookups_double = self.count_lookups(regex, code_nested_ifs * 2)
+        self.assertEqual(matches_double, 2 * matches_single)
+        self.assertLessEqual(lookups_double, 2 * lookups_single + 1)
+
+
+class TestPikeEngine(unittest.TestCase):
+    cases = [
+        (code_simple_function, "s"),
+        ("123123123", "123"),
+        (code_simple_function, "z*z;|s"),
+        (code_simple_statement, ";id + 5 * ;num"),
+        (code_simple_statement, ";expr"),
+        (code_simple_statement, ";stmt"),
+        (code_number, "2;(1;+;)"),
+        (code_number, "2;(1;*;)"),
+        (code_number, "2;(1;?;)"),
+        (code_number, "2;(;(1;?;);*;)"),
+        (code_asserts, "assert(;(2;?1;*;) == len(;str));|assertEqual(2;(1;+;), ;(;id;|;num;))"),
+
+        (code_nested_ifs, "if ;(;(;expr;| ;);*;);*:"),
+        ("11\n2", "1;*"),
+    ]
+
+    def test_pike_matches_backtrack(self):
+        for code, regex in self.cases:
+            grep = GrammarGrep(code)
+            self.assertEqual(grep.match(regex, engine="pike"), grep.match(regex, engine="backtrack"), regex)
+
+    def test_unanchored_matches_pike(self):
+        for code, regex in self.cases:
+            grep = GrammarGrep(code)
+            pattern = gg.compile(regex)
+            self.assertEqual(list(pattern.finditer(grep, engine="unanchored")),
+                             list(pattern.finditer(grep, engine="pike")), regex)
+
+    def test_unanchored_empty_match_after_line_end(self):
+        grep = GrammarGrep("11\n2")
+        self.assertEqual(grep.match("1;*", engine="unanchored"), [((0, 0), (0, 2)), ((0, 2), (0, 2)), ((1, 0), (1, 0))])
+
+    def test_unanchored_linear_under_long_thread(self):
+        # the thread of the def stays pending over the whole scan while every name inside it is accepted
+        grep = GrammarGrep("def f():\n" + "".join("    x{} = {}\n".format(i, i) for i in range(16000)))
+        grep.labels
+        start = time.time()
+        self.assertEqual(grep.match(";stmt;|;id", engine="unanchored"), [((0, 0), (16000, 18))])
+        self.assertLess(time.time() - start, 1)
+
+    def test_pike_replace(self):
+        grep = GrammarGrep(code_simple_statement)
+        self.assertEqual(grep.replace(";(;id;) ;(+;) ;num * ;(;num;)", ['x', '-', 'z'], engine="pike"),
+                         ["x = x - 5 * z"])
+        grep = GrammarGrep("AAAAAAAAAAA")
+        self.assertEqual(grep.replace(";(A;*;)", ['B'], engine="pike"), ["B"])
+
+    def test_unknown_engine(self):
+        grep = GrammarGrep(code_simple_statement)
+        self.assertRaises(ValueError, grep.match, ";id", "dfs")
+
+
+class TestCompiledEngine(unittest.TestCase):
+
+    def test_compiled_matches_backtrack(self):
+        for code, regex in TestPikeEngine.cases:
+            grep = GrammarGrep(code)
+            pattern = gg.compile(regex)
+            self.assertEqual(list(pattern.finditer(grep, engine="compiled")),
+                             list(pattern.finditer(grep, engine="backtrack")), regex)
+
+    def test_compiled_matcher_is_cached(self):
+        nfa = RegExParser.regex_to_nfa(";id = ;(;num;|;str;)")
+        match_at = nfa.compiled_match_at()
+        self.assertIsNotNone(match_at)
+        self.assertIs(nfa.compiled_match_at(), match_at)
+        self.assertIn("text.startswith('if ', offset)", RegExParser.regex_to_nfa("if ;expr:").generate_match_source())
+
+    def test_large_automata_is_interpreted(self):
+        regex = ";|".join(";id.w{}".format(i) for i in range(3000))
+        nfa = RegExParser.regex_to_nfa(regex)
+        self.assertIsNone(nfa.compiled_match_at())
+        grep = GrammarGrep("x.w12 = 1")
+        self.assertEqual(grep.match(regex, engine="compiled"), [((0, 0), (0, 5))])
+
+
+class TestLazyDFA(unittest.TestCase):
+
+    def test_dfa_matches_backtrack(self):
+        for code, regex in TestPikeEngine.cases:
+            grep = GrammarGrep(code)
+            pattern = gg.compile(regex)
+            self.assertEqual(list(pattern.finditer(grep, engine="dfa")),
+                             list(pattern.finditer(grep, engine="backtrack")), regex)
+
+    def test_longest_match_end(self):
+        grep = GrammarGrep(code_asserts)
+        dfa = LazyDFA(RegExParser.regex_to_nfa("assertEqual(;expr, ;(;num;|;id;)"))
+        text, offset = grep.code_text.text, grep.code_text.offset
+        self.assertEqual(dfa.longest_match(text, grep.labels, offset((2, 3))), offset((2, 21)))
+        self.assertIsNone(dfa.longest_match(text, grep.labels, offset((1, 3))))
+        states = len(dfa)
+        self.assertEqual(dfa.longest_match(text, grep.labels, offset((7, 3))), offset((7, 19)))
+        # the states and transitions are cached, reading the same kind of text again adds none
+        self.assertEqual(len(dfa), states)
+
+    def test_spans_track_no_groups(self):
+        grep = GrammarGrep(code_asserts)
+        nfa = RegExParser.regex_to_nfa("assertEqual(;(;expr;), ;(;num;|;id;)")
+        self.assertEqual(list(nfa.span_generator(grep.code, grep.labels)),
+                         [m for m, _ in nfa.match_generator(grep.code, grep.labels)])
+        # the groups are never looked for
+        with mock.patch.object(GrammarAutomata, "captures_to_groups", side_effect=AssertionError):
+            self.assertEqual(nfa.match_all(grep.code, grep.labels),
+                             [((2, 3), (2, 21)), ((6, 3), (6, 25)), ((7, 3), (7, 19))])
+        self.assertEqual(gg.compile(";id;|;str").count(code_simple_function), 7)
+
+    def test_chosen_engine_finds_its_spans(self):
+        grep = GrammarGrep(code_asserts)
+        regex = "assertEqual(;expr, ;(;num;|;id;)"
+        expected = grep.match(regex)
+        for engine, method in [("backtrack", "match_at"), ("pike", "pike_match_at"), ("compiled", "compiled_match_at"),
+                               ("unanchored", "unanchored_match_generator")]:
+            self.assertEqual(grep.match(regex, engine), expected, engine)
+            with mock.patch.object(GrammarAutomata, method, side_effect=AssertionError):
+                with self.assertRaises(AssertionError):
+                    grep.match(regex, engine)
+        # without an engine chosen the spans are the lazy dfa's only
+        with mock.patch.object(GrammarAutomata, "match_at", side_effect=AssertionError):
+            self.assertEqual(grep.match(regex), expected)
+
+    def test_groups_searched_within_spans(self):
+        grep = GrammarGrep(code_asserts)
+        pattern = gg.compile("assertEqual(;expr, ;(;num;|;id;)")
+        expected = list(pattern.finditer(grep, "backtrack"))
+        replaced = pattern.sub(["x"], grep, "backtrack")
+        # without an engine chosen the lazy dfa finds the spans and the backtrack search runs for the matches only,
+        # from their begin to their end
+        match_at = GrammarAutomata.match_at
+        with mock.patch.object(GrammarAutomata, "match_at", autospec=True, side_effect=match_at) as match_at_spy:
+            self.assertEqual(list(pattern.finditer(grep)), expected)
+            self.assertEqual(pattern.sub(["x"], grep), replaced)
+        offset = grep.code_text.offset
+        self.assertEqual([call.args[3:] for call in match_at_spy.call_args_list],
+                         [(offset(begin), offset(end)) for (begin, end), _ in expected] * 2)
+
+    def test_flush_on_overflow(self):
+        grep = GrammarGrep(code_nested_ifs)
+        regex = "if ;(;(;expr;| ;);*;);*:"
+        nfa = RegExParser.regex_to_nfa(regex, dfa_states_max=2)
+        self.assertEqual(list(nfa.match_generator(grep.code, grep.labels, "dfa")),
+                         list(nfa.match_generator(grep.code, grep.labels, "backtrack")))
+        self.assertGreater(nfa.get_dfa().flushes, 0)
+        self.assertLessEqual(len(nfa.get_dfa()), 2)
+
+    def test_dfa_states_max_per_compile(self):
+        regex = "if ;(;(;expr;| ;);*;);*: "
+        pattern = gg.compile(regex, dfa_states_max=2)
+        self.assertEqual(pattern.findall(code_nested_ifs, "dfa"), gg.compile(regex).findall(code_nested_ifs, "dfa"))
+        self.assertLessEqual(len(pattern.automata.get_dfa()), 2)
+        # the cap is part of the cache key, the automata of the pattern compiled without one keeps the default
+        self.assertIsNot(pattern.automata, gg.compile(regex).automata)
+        self.assertEqual(gg.compile(regex).automata.dfa_states_max, DFA_STATES_MAX)
+
+    def test_dfa_per_thread(self):
+        grep = GrammarGrep(code_nested_ifs)
+        nfa = RegExParser.regex_to_nfa("if ;(;(;expr;| ;);*;);*:", dfa_states_max=2)
+        expected = nfa.match_all(grep.code, grep.labels, "backtrack")
+        results = []
+
+        def find():
+            results.extend(nfa.match_all(grep.code, grep.labels, "dfa") == expected for _ in range(20))
+        threads = [threading.Thread(target=find) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 160)
+
+
+class TestCaptures(unittest.TestCase):
+
+    def test_repeated_group_iterations(self):
+        pattern = gg.compile(";(;id, ;);+")
+        for engine in ["backtrack", "pike", "unanchored", "compiled", "dfa"]:
+            self.assertEqual(list(pattern.finditer("f(a, b, c, d)", engine)),
+                             [(((0, 2), (0, 11)), {0: [((0, 8), (0, 11))]})])
+            self.assertEqual(list(pattern.finditer("f(a, b, c, d)", engine, all_iterations=True)),
+                             [(((0, 2), (0, 11)), {0: [((0, 2), (0, 5)), ((0, 5), (0, 8)), ((0, 8), (0, 11))]})])
+            self.assertEqual(pattern.sub(["x, "], "f(a, b, c, d)", engine), ["f(a, b, x, d)"])
+            self.assertEqual(pattern.sub(["x, "], "f(a, b, c, d)", engine, all_iterations=True), ["f(x, x, x, d)"])
+
+    def test_delegated_pattern_iterations(self):
+        pattern = gg.compile(";(12;);+")
+        self.assertIsNotNone(pattern.automata.re_pattern)
+        self.assertEqual(list(pattern.finditer("x121212")), [(((0, 1), (0, 7)), {0: [((0, 5), (0, 7))]})])
+        # the re module only finds where the match begins, its groups are the automata's
+        self.assertEqual(list(pattern.finditer("x121212", all_iterations=True)),
+                         [(((0, 1), (0, 7)), {0: [((0, 1), (0, 3)), ((0, 3), (0, 5)), ((0, 5), (0, 7))]})])
+
+    def test_captures_are_shared_tags(self):
+        captures = GrammarAutomata.apply_tags(None, (0, 2), 1)
+        forked = GrammarAutomata.apply_tags(captures, (1,), 4)
+        self.assertIs(forked[2], captures)
+        self.assertEqual(forked, (1, 4, (2, 1, (0, 1, None))))
+        # the inner group began but never ended
+        self.assertEqual(GrammarAutomata.captures_to_groups(forked), {0: [(1, 4)]})
+
+    def test_groups_do_not_depend_on_the_engine(self):
+        for code, regex in TestPikeEngine.cases:
+            grep = GrammarGrep(code)
+            pattern = gg.compile(regex)
+            self.assertEqual(list(pattern.finditer(grep, "backtrack", True)),
+                             list(pattern.finditer(grep, "pike", True)), regex)
+
+
+class TestSkipLiteral(unittest.TestCase):
+
+    def test_leading_literal(self):
+        self.assertEqual(RegExParser.regex_to_nfa("if len(;id) > 0:").skip_literal, ("if len(", 0, 0))
+        self.assertEqual(RegExParser.regex_to_nfa("assertEqual(;expr;|assert(;expr").skip_literal, ("assert", 0, 0))
+
+    def test_inner_literal(self):
+        self.assertEqual(RegExParser.regex_to_nfa("2;?1;?x").skip_literal, ("x", 0, 2))
+        self.assertEqual(RegExParser.regex_to_nfa(";id = ;str").skip_literal, (" = ", 1, None))
+
+    def test_no_required_literal(self):
+        self.assertIsNone(RegExParser.regex_to_nfa(";num").skip_literal)
+        self.assertIsNone(RegExParser.regex_to_nfa("a;|b").skip_literal)
+        self.assertIsNone(RegExParser.regex_to_nfa("x;(;id;)zz;*").skip_literal)
+
+    def test_skipping_keeps_matches(self):
+        for code, regex in [(code_asserts, "assertEqual(;num, ;(;id;|;num;))"), (code_asserts, ";id == len(;id)"),
+                            (code_number, "2;?1;?1"), (code_simple_function, ";id = ;str")]:
+            grep = GrammarGrep(code)
+            nfa_skipping = RegExParser.regex_to_nfa(regex)
+            nfa = RegExParser.regex_to_nfa(regex)
+            nfa.skip_literal = None
+            for engine in ["backtrack", "unanchored"]:
+                self.assertEqual(nfa_skipping.match_all(grep.code, grep.labels, engine),
+                                 nfa.match_all(grep.code, grep.labels, engine), regex)
+
+
+class TestFirstLabelTypes(unittest.TestCase):
+
+    def test_first_label_types(self):
+        self.assertEqual(RegExParser.regex_to_nfa(";num").first_label_types, frozenset(["num_type"]))
+        self.assertEqual(RegExParser.regex_to_nfa(";(;id;|;str;) = ;expr").first_label_types,
+                         frozenset(["id_type", "str_type"]))
+        self.assertIsNone(RegExParser.regex_to_nfa(";id;|x").first_label_types)
+        self.assertIsNone(RegExParser.regex_to_nfa(";id;?").first_label_types)
+
+    def test_only_label_starts_are_tried(self):
+        grep = GrammarGrep(code_asserts)
+        grep.labels = CountingLabels(grep.labels)
+        matches = grep.match(";num")
+        self.assertEqual(len(matches), 8)
+        self.assertEqual(grep.labels.lookups, 8)
+
+
+class TestLabelIndex(unittest.TestCase):
+
+    def test_ends_by_type_code(self):
+        grep = GrammarGrep(code_simple_statement)
+        ends = grep.labels[4]
+        self.assertEqual(ends[LABEL_CODES["expr_type"]], (13, 5))
+        self.assertEqual(ends[LABEL_CODES["id_type"]], (5,))
+        self.assertIs(ends[LABEL_CODES["num_type"]], NO_ENDS)
+
+    def test_check_does_not_allocate_on_miss(self):
+        grep = GrammarGrep(code_simple_statement)
+        ga_num = GrammarAutomata.create_automata_meta("num_type")
+        ga_plus = GrammarAutomata.create_automata_matching("+")
+        self.assertIs(ga_num.check_edge(0, grep.code_text.text, grep.labels, 4), NO_ENDS)
+        self.assertIs(ga_num.check_edge(0, grep.code_text.text, grep.labels, 1), NO_ENDS)
+        self.assertIs(ga_plus.check_edge(0, grep.code_text.text, grep.labels, 4), NO_ENDS)
+        self.assertEqual(ga_plus.check_edge(0, grep.code_text.text, grep.labels, 6), (7,))
+
+
+class TestAutomataLayout(unittest.TestCase):
+
+    def test_states_are_flat_arrays(self):
+        nfa = RegExParser.regex_to_nfa("a;(;id;);|b")
+        self.assertEqual(len(nfa.edge_dst), len(nfa.edge_kind))
+        self.assertEqual(len(nfa.edge_dst), len(nfa.edge_literal))
+        state_count = len(nfa.state_edges)
+        self.assertEqual(nfa.accepting, tuple(state == state_count - 1 for state in range(state_count)))
+        self.assertEqual(sorted(nfa.literals), ["a", "b"])
+        self.assertFalse(hasattr(nfa, "__dict__"))
+
+    def test_group_tables(self):
+        nfa = RegExParser.regex_to_nfa(";(;(;id;) = ;(;num;);)")
+        self.assertEqual(len(nfa.state_groups_begin), len(nfa.state_edges))
+        for group_index, begin_state, end_state in nfa.groups:
+            self.assertIn(group_index, nfa.state_groups_begin[begin_state])
+            self.assertIn(group_index, nfa.state_groups_end[end_state])
+        self.assertEqual(sum(len(group_indices) for group_indices in nfa.state_groups_end), 3)
+
+    @staticmethod
+    def compile_time(regex):
+        times = []
+        for _ in range(3):
+            time_begin = time.perf_counter()
+            RegExParser.regex_to_nfa(regex)
+            times.append(time.perf_counter() - time_begin)
+        return min(times)
+
+    def test_compile_linear_in_pattern_size(self):
+        for piece in ["a;id", "ab;*"]:
+            # a quadratic builder would take about 16 times longer
+            self.assertLess(self.compile_time(piece * 1600), 10 * self.compile_time(piece * 400))
+
+
+class TestRegExParser(unittest.TestCase):
+
+    def assertCompileErrorAt(self, regex, offset):
+        with self.assertRaises(RuntimeError) as context:
+            RegExParser.regex_to_nfa(regex)
+        self.assertTrue(str(context.exception).endswith("at offset {}".format(offset)), str(context.exception))
+
+    def test_error_offsets(self):
+        self.assertCompileErrorAt(";(;(;x))", 4)
+        self.assertCompileErrorAt("a;(b;(c;)", 1)
+        self.assertCompileErrorAt("ab;)", 2)
+        self.assertCompileErrorAt("a;|;*", 3)
+        self.assertCompileErrorAt(";|b", 0)
+        self.assertCompileErrorAt("a;|", 3)
+        self.assertCompileErrorAt("a;(;)", 3)
+        self.assertCompileErrorAt("a;", 1)
+        self.assertCompileErrorAt("", 0)
+
+    def test_groups_numbered_in_order(self):
+        _, groups = next(gg.compile(";(;(;id;) = ;(;num;);)").finditer("x = 1"))
+        self.assertEqual(groups, {0: [((0, 0), (0, 5))], 1: [((0, 0), (0, 1))], 2: [((0, 4), (0, 5))]})
+
+    def test_long_alternation(self):
+        words = ["word{}".format(i) for i in range(5000)] + ["x"]
+        self.assertEqual(gg.compile(";|".join(words)).findall("x = 1"), [((0, 0), (0, 1))])
+
+    def test_deep_nesting(self):
+        depth = 2000
+        pattern = gg.compile(";(" * depth + "x" + ";)" * depth)
+        match, groups = next(pattern.finditer("x = 1", "pike"))
+        self.assertEqual(match, ((0, 0), (0, 1)))
+        self.assertEqual(len(groups), depth)
+
+
+class TestPatternTree(unittest.TestCase):
+
+    def test_merge_adjacent_literals(self):
+        self.assertEqual(RegExParser.regex_to_tree("ab;(c;)de;id"), ("concat", None, (
+            ("str", "ab", ()), ("group", 0, (("str", "c", ()),)), ("str", "de", ()), ("meta", "id_type", ()))))
+
+    def test_factor_common_prefixes(self):
+        self.assertEqual(RegExParser.regex_to_tree("assert(;|assertEqual(;|x"), ("or", None, (
+            ("concat", None, (("str", "assert", ()), ("or", None, (("str", "(", ()), ("str", "Equal(", ()))))),
+            ("str", "x", ()))))
+        # an alternative is never left empty
+        self.assertEqual(RegExParser.regex_to_tree("ab;|a"), ("or", None, (("str", "ab", ()), ("str", "a", ()))))
+
+    def test_factor_nested_prefixes_of_long_alternation(self):
+        # every alternative is a prefix of the next ones, so the prefixes nest as deep as the alternation is long
+        pattern = gg.compile(";|".join("x" * i + ";(y;)" for i in range(1, 1000)))
+        self.assertEqual(list(pattern.finditer('a = "xxxy"\nb = "' + "x" * 998 + 'y"')),
+                         [(((0, 5), (0, 9)), {2: [((0, 8), (0, 9))]}),
+                          (((1, 5), (1, 1004)), {997: [((1, 1003), (1, 1004))]})])
+
+    def test_simplify_nested_repeats(self):
+        self.assertEqual(RegExParser.regex_to_tree("a;*;?"), ("star", None, (("str", "a", ()),)))
+        self.assertEqual(RegExParser.regex_to_tree("a;+;?"), ("star", None, (("str", "a", ()),)))
+        self.assertEqual(RegExParser.regex_to_tree("a;+;+"), ("plus", None, (("str", "a", ()),)))
+        # repeats around groups keep their captures
+        self.assertEqual(RegExParser.regex_to_tree(";(a;);+;?")[0], "question")
+
+    def test_concat_adds_no_epsilon_edges(self):
+        nfa = RegExParser.regex_to_nfa("x = ;id + ;num")
+        self.assertEqual(len(nfa.state_edges), 5)
+        self.assertNotIn(KIND_EPSILON, nfa.edge_kind)
+
+    def test_optimized_matches(self):
+        grep = GrammarGrep(code_asserts)
+        for engine in ["backtrack", "pike", "unanchored"]:
+            self.assertEqual(grep.match("assert(;|assertEqual(;|ass;+", engine),
+                             [((1, 3), (1, 10)), ((2, 3), (2, 15)), ((4, 3), (4, 10)), ((5, 3), (5, 10)),
+                              ((6, 3), (6, 15)), ((7, 3), (7, 15))])
+
+
+    def test_literal_alternation_trie(self):
+        self.assertEqual(RegExParser.regex_to_tree("len;|assert;|ab;|abc;|x"),
+                         ("trie", ("len", "assert", "ab", "abc", "x"), ()))
+        # literal prefixed alternatives continuing with the same sequence share it after the trie
+        self.assertEqual(RegExParser.regex_to_tree("f(;expr;|g(;expr;|h(;expr;|len(;expr"), ("concat", None, (
+            ("trie", ("f(", "g(", "h(", "len("), ()), ("meta", "expr_type", ()))))
+        # a few alternatives are left as they are
+        self.assertEqual(RegExParser.regex_to_tree("a;|b")[0], "or")
+        nfa = RegExParser.regex_to_nfa(";(" + ";|".join("name{}".format(i) for i in range(100)) + ";)")
+        self.assertEqual(len(nfa.edge_kind), 1)
+
+    def test_trie_matches(self):
+        grep = GrammarGrep(code_asserts)
+        pattern = ";(name;|assert;|assertEqual;|len;|x;)(;|name"
+        for engine in ["backtrack", "pike", "unanchored"]:
+            self.assertEqual(grep.match(pattern, engine),
+                             [((1, 3), (1, 10)), ((1, 16), (1, 20)), ((2, 3), (2, 15)), ((3, 3), (3, 7)),
+                              ((4, 3), (4, 10)), ((4, 15), (4, 19)), ((4, 19), (4, 23)), ((5, 3), (5, 10)),
+                              ((5, 16), (5, 20)), ((5, 20), (5, 24)), ((6, 3), (6, 15)), ((6, 21), (6, 25)),
+                              ((7, 3), (7, 15))])
+            self.assertEqual(grep.match(";(name;|assert;|assertEqual;|len;|x;)(;expr)", engine),
+                             [((1, 3), (1, 25)), ((4, 3), (4, 25)), ((5, 3), (5, 26))])
+
+
+class TestEpsilonClosure(unittest.TestCase):
+
+    def test_closure_skips_epsilon_edges(self):
+        nfa = RegExParser.regex_to_nfa("a;*;(b;);|c")
+        closure_edges, closure_accept = nfa.get_closure(0)
+        self.assertCountEqual([nfa.literals[nfa.edge_literal[edge]] for edge, _ in closure_edges], ["a", "b", "c"])
+        self.assertNotIn(KIND_EPSILON, [nfa.edge_kind[edge] for edge, _ in closure_edges])
+        self.assertIsNone(closure_accept)
+
+    def test_group_markers_are_tags(self):
+        nfa = RegExParser.regex_to_nfa("x;(;(y;);?;)")
+        closure_edges, closure_accept = nfa.get_closure(nfa.edge_dst[nfa.get_closure(0)[0][0][0]])
+        # both groups begin on the way to y, skipping y leaves the inner group without an end
+        self.assertEqual([tags for _, tags in closure_edges], [(0, 2)])
+        self.assertEqual(closure_accept, (0, 2, 1))
+
+    def test_backtrack_empty_group(self):
+        grep = GrammarGrep("ab")
+        for engine in ["backtrack", "pike", "unanchored"]:
+            self.assertEqual(list(gg.compile("a;(;(c;);?;)b").finditer(grep, engine)),
+                             [(((0, 0), (0, 2)), {0: [((0, 1), (0, 1))]})])
+
+
+class TestRequirements(unittest.TestCase):
+
+    def test_required_literals_and_label_types(self):
+        nfa = RegExParser.regex_to_nfa("assertEqual(;num, ;(;id;|;str;))")
+        self.assertEqual(set(nfa.required_literals), {"assertEqual(", ", ", ")"})
+        self.assertEqual(nfa.required_label_types, {"num_type"})
+        nfa = RegExParser.regex_to_nfa("x = ;(1;|;id;)")
+        self.assertEqual(nfa.required_literals, ("x = ",))
+        self.assertEqual(nfa.required_label_types, frozenset())
+
+    def test_missing_literal_skips_parse(self):
+        grep = GrammarGrep("def f(:")
+        self.assertEqual(grep.match("assertEqual(;num"), [])
+        self.assertEqual(grep.replace(";(assert;)", ["check"]), ["def f(:"])
+        self.assertIsNone(grep._labels)
+        with self.assertRaises(SyntaxError):
+            grep.match("def ;id")
+
+    def test_missing_label_type_skips_search(self):
+        grep = GrammarGrep("x = 'a'\ny = x")
+        grep.labels = CountingLabels(grep.labels)
+        self.assertEqual(grep.match("= ;num"), [])
+        self.assertEqual(grep.labels.lookups, 0)
+        self.assertEqual(grep.match("= ;id"), [((1, 2), (1, 5))])
+
+
+class TestReDelegation(unittest.TestCase):
+
+    def test_literal_patterns_are_delegated(self):
+        self.assertIsNotNone(RegExParser.regex_to_nfa("assert;(Equal;)?(").re_pattern)
+        self.assertIsNotNone(RegExParser.regex_to_nfa("assert;(Equal;|True;)(").re_pattern)
+        self.assertIsNone(RegExParser.regex_to_nfa("assert(;expr").re_pattern)
+        # the empty matches of nullable patterns stay with the automata, which still needs no labels
+        nfa = RegExParser.regex_to_nfa("a;*")
+        self.assertIsNone(nfa.re_pattern)
+        self.assertFalse(nfa.uses_labels)
+
+    def test_delegated_match_skips_parse(self):
+        grep = GrammarGrep("def f(:\n    assertEqual(1, 2)")
+        self.assertEqual(grep.match("assert;|assertEqual("), [((1, 4), (1, 16))])
+        self.assertIn(((1, 19), (1, 20)), grep.match("2;*"))
+        self.assertIsNone(grep._labels)
+
+    def test_delegated_match_is_leftmost_longest(self):
+        grep = GrammarGrep(code_asserts)
+        for regex in ["bs;|as;(sert;)", ";(as;);(s;|t;)ert", "1;(1;);+", "2;(1;+;)"]:
+            nfa = RegExParser.regex_to_nfa(regex)
+            self.assertIsNotNone(nfa.re_pattern, regex)
+            matches = list(nfa.match_generator(grep.code, None))
+            nfa.re_pattern = None
+            self.assertEqual(matches, list(nfa.match_generator(grep.code, grep.labels, "pike")), regex)
+        self.assertEqual(list(gg.compile(";(as;);(s;|sert;);(;(Equal;);?;)").finditer("assertEqual(1, 1)")),
+                         [(((0, 0), (0, 11)), {0: [((0, 0), (0, 2))], 1: [((0, 2), (0, 6))], 2: [((0, 6), (0, 11))],
+                                            3: [((0, 6), (0, 11))]})])
+
+    def test_delegated_groups_are_the_automatas(self):
+        for regex in [";(;(a;);+;)a", "x;(a;|bc;);(d;|cd;)"]:
+            nfa = RegExParser.regex_to_nfa(regex)
+            self.assertIsNotNone(nfa.re_pattern)
+            nfa_automata = RegExParser.regex_to_nfa(regex)
+            nfa_automata.re_pattern = None
+            for engine in ["backtrack", "pike", "dfa"]:
+                self.assertEqual(list(nfa.match_generator(["aaa xad xbccd"], None, engine)),
+                                 list(nfa_automata.match_generator(["aaa xad xbccd"], None, engine)), regex)
+
+    def test_no_catastrophic_backtracking(self):
+        self.assertIsNone(RegExParser.regex_to_nfa(";(;(a;);+;);+b").re_pattern)
+        self.assertIsNotNone(RegExParser.regex_to_nfa("1;+").re_pattern)
+        start = time.time()
+        self.assertEqual(gg.compile(";(;(a;);+;);+b").findall('b = "' + "a" * 40 + 'c"'), [])
+        self.assertEqual(gg.compile("1;+").count("x = [" + "1, " * 8000 + "]"), 8000)
+        self.assertLess(time.time() - start, 1)
+
+    def test_choices_stay_with_the_automata(self):
+        # optional parts, alternatives of which one is a prefix of another and a second loop make the re module
+        # backtrack exponentially or polynomially, the automata finds the begins of these patterns itself
+        regexes = [";(a;|aa;)" * 22 + "b", ";(a;?;)" * 24 + "a" * 24 + "b", ";(ab;);*c;(ab;);*d", "a;|ab"]
+        for regex in regexes:
+            self.assertIsNone(RegExParser.regex_to_nfa(regex).re_pattern, regex)
+        code = 'x = "' + "a" * 60 + 'cb"'
+        start = time.time()
+        for regex in regexes[:2]:
+            for engine in ["backtrack", "pike", "dfa"]:
+                self.assertEqual(gg.compile(regex).findall(code, engine), [], regex)
+        self.assertEqual(gg.compile(regexes[2]).count("x = '" + "ab" * 20000 + "'"), 0)
+        self.assertLess(time.time() - start, 1)
+
+
+class TestSuperset(unittest.TestCase):
+
+    def test_tree_to_superset(self):
+        self.assertEqual(RegExParser.tree_to_superset(RegExParser.regex_to_tree("print(;expr, ;expr)")),
+                         ["print\\(", None, ",\\ ", None, "\\)"])
+        self.assertEqual(RegExParser.tree_to_superset(RegExParser.regex_to_tree(";id = ;num")),
+                         ["\\w+\\ =\\ ", None, "[\\d.][\\w.+-]*"])
+        # repeats and alternations over labels match anything
+        self.assertEqual(RegExParser.tree_to_superset(RegExParser.regex_to_tree(";expr;*")), [None])
+        self.assertEqual(RegExParser.tree_to_superset(RegExParser.regex_to_tree("x;|;expr")), [None])
+        self.assertEqual(RegExParser.tree_to_superset(RegExParser.regex_to_tree("x;|;id")), ["(?:x|\\w+)"])
+        # so are repeats of anything but a single string, the re module would backtrack exponentially on them
+        self.assertEqual(RegExParser.tree_to_superset(RegExParser.regex_to_tree(";(;(a;);+;);+ = ;id")),
+                         [None, "\\ =\\ \\w+"])
+        self.assertEqual(RegExParser.tree_to_superset(RegExParser.regex_to_tree(";(ab;);+ = ;id")),
+                         ["(?:ab)+\\ =\\ ", None, "\\w+"])
+        # and a regex holds a single part matching in several ways, a wildcard splits off the next one
+        self.assertEqual(RegExParser.tree_to_superset(RegExParser.regex_to_tree(";(a;|aa;);(a;|aa;)b;id")),
+                         ["(?:a|aa)", None, "(?:a|aa)b", None, "\\w+"])
+
+    def test_superset_search_is_linear(self):
+        grep = GrammarGrep('x = "' + "a" * 40 + '" # = y')
+        start = time.time()
+        self.assertEqual(grep.match(";(;(a;);+;);+ = ;id"), [])
+        self.assertLess(time.time() - start, 1)
+        grep = GrammarGrep('x = "' + "a" * 60 + 'cb = y"')
+        start = time.time()
+        self.assertEqual(grep.match(";(a;|aa;)" * 22 + "b = ;id"), [])
+        self.assertLess(time.time() - start, 1)
+
+    def test_superset_miss_skips_parse(self):
+        grep = GrammarGrep("def f(:\n    print(x)")
+        self.assertEqual(grep.match("print(;expr, ;expr)"), [])
+        self.assertIsNone(grep._labels)
+
+    def test_superset_keeps_matches(self):
+        grep = GrammarGrep(code_asserts)
+        for regex in ["assertEqual(;num, ;expr)", ";id == len(;(;id;))", "a;id(;expr"]:
+            nfa = RegExParser.regex_to_nfa(regex)
+            self.assertIsNotNone(nfa.superset_regexes, regex)
+            matches = list(nfa.match_generator(grep.code, grep.labels))
+            nfa.set_superset([None])
+            self.assertEqual(matches, list(nfa.match_generator(grep.code, grep.labels)), regex)
+
+
+class TestCompiledPattern(unittest.TestCase):
+
+    def test_compiled_pattern_over_many_sources(self):
+        pattern = gg.compile(";num")
+        self.assertEqual(pattern.findall(code_simple_statement), [((0, 8), (0, 9)), ((0, 12), (0, 13))])
+        self.assertEqual(pattern.findall(GrammarGrep(code_number)), [((0, 0), (0, 6))])
+        self.assertEqual(pattern.count(code_asserts), 8)
+
+    def test_compiled_pattern_search(self):
+        pattern = gg.compile("assertEqual(;num")
+        self.assertEqual(pattern.search(code_asserts), ((2, 3), (2, 17)))
+        self.assertIsNone(pattern.search(code_simple_function))
+
+    def test_compiled_pattern_finditer_groups(self):
+        pattern = gg.compile(";(;id;) + ;(;num;)")
+        self.assertEqual(list(pattern.finditer(code_simple_statement)),
+                         [(((0, 4), (0, 9)), {0: [((0, 4), (0, 5))], 1: [((0, 8), (0, 9))]})])
+
+    def test_compiled_pattern_sub(self):
+        pattern = gg.compile(";(+;)")
+        self.assertEqual(pattern.sub(['-'], code_simple_statement), ["x = y - 5 * 3"])
+
+    def test_compiled_pattern_is_immutable(self):
+        pattern = gg.compile(";id")
+        self.assertEqual(pattern.pattern, ";id")
+        with self.assertRaises(AttributeError):
+            pattern.pattern = ";num"
+
+
+class TestPatternSet(unittest.TestCase):
+
+    def test_pattern_set_matches_every_rule(self):
+        rules = [";num", "assert;(Equal;)?(;expr", ";(;id;) == len(;(;id;))", "2;+"]
+        patterns = gg.compile_set(rules)
+        self.assertEqual(len(patterns), 4)
+        self.assertEqual(patterns.findall(code_asserts), [gg.compile(rule).findall(code_asserts) for rule in rules])
+
+    def test_pattern_set_single_pass(self):
+        rules = [";(;num;) == len(;(;id;))", ";num", "assertEqual(;(;num;)"]
+        grep = GrammarGrep(code_asserts)
+        matches = list(gg.compile_set(rules).finditer(grep))
+        self.assertEqual(matches, sorted([(rule, m, groups) for rule, regex in enumerate(rules)
+                                          for m, groups in gg.compile(regex).finditer(grep, "pike")],
+                                         key=lambda match: (match[1][0], match[0])))
+        self.assertIn((0, ((4, 10), (4, 24)), {0: [((4, 10), (4, 11))], 1: [((4, 19), (4, 23))]}), matches)
+
+    def test_pattern_set_shares_no_states(self):
+        nfa = gg.compile_set(["a;|b", ";(c;)"]).automata
+        self.assertEqual(len(nfa.rule_starts), 2)
+        self.assertEqual(nfa.rule_group_counts, (0, 1))
+        self.assertEqual(sum(nfa.accepting), 2)
+
+    def test_pattern_set_bypasses_cache(self):
+        rules = [";id == {}".format(i) for i in range(200)]
+        stats = gg.pattern_cache.stats()
+        patterns = gg.compile_set(rules)
+        self.assertEqual(gg.pattern_cache.stats(), stats)
+        self.assertEqual(patterns.findall("x == 7"), [[((0, 0), (0, 6))] if i == 7 else [] for i in range(200)])
+
+    def test_pattern_set_prefilter(self):
+        rules = ["assertEqual(;num", "len(;id)", ";id.append(;expr)", "2;+"]
+        patterns = gg.compile_set(rules)
+        self.assertEqual(patterns.candidates(code_asserts), [0, 1, 3])
+        self.assertEqual(patterns.findall(code_asserts), [gg.compile(rule).findall(code_asserts) for rule in rules])
+
+
+class TestCodeText(unittest.TestCase):
+
+    def test_offsets_and_positions(self):
+        code = CodeText(["ab", "", "cde"])
+        self.assertEqual(code.text, "ab\n\ncde")
+        self.assertEqual([code.offset(position) for position in ((0, 0), (0, 2), (1, 0), (2, 3))], [0, 2, 3, 7])
+        self.assertEqual([code.position(offset) for offset in range(len(code) + 1)],
+                         [(0, 0), (0, 1), (0, 2), (1, 0), (2, 0), (2, 1), (2, 2), (2, 3)])
+
+    def test_next_begin_skips_line_ends(self):
+        code = CodeText(["ab", "", "cde"])
+        begins = [0]
+        while begins[-1] != -1:
+            begins.append(code.next_begin(begins[-1]))
+        self.assertEqual(begins, [0, 1, 3, 4, 5, 6, -1])
+        self.assertTrue(code.is_line_end(2))
+        self.assertFalse(code.is_line_end(3))
+
+    def test_match_spanning_lines(self):
+        grep = GrammarGrep("x = f(1 +\n      2)\n")
+        self.assertEqual(gg.compile("f(;expr)").findall(grep), [((0, 4), (1, 8))])
+        self.assertEqual(list(gg.compile("f(;(;expr;))").finditer(grep)), [(((0, 4), (1, 8)), {0: [((0, 6), (1, 7))]})])
+
+    def test_line_break_literals_begin_alike(self):
+        grep = GrammarGrep("x = 1\ny = 2")
+        # delegated to the re module or not, a match never begins at the end of a line
+        for regex in ["\ny", "\ny;|;id", "\n;|QQQ"]:
+            for engine in [None, "backtrack", "pike", "unanchored", "compiled", "dfa"]:
+                self.assertNotIn(((0, 5), (1, 1)), gg.compile(regex).findall(grep, engine), regex)
+                self.assertEqual(list(gg.compile(regex).finditer(grep, engine, all_iterations=True)),
+                                 list(gg.compile(regex).finditer(grep, engine)), regex)
+        self.assertEqual(gg.compile("1\ny").findall(grep), [((0, 4), (1, 1))])
+        self.assertEqual(gg.compile("1\ny;|;num").findall(grep), [((0, 4), (1, 1)), ((1, 4), (1, 5))])
+
+    def test_prefilter_on_code_text(self):
+        grep = GrammarGrep("a = 1\r\nb = 2")
+        self.assertEqual(gg.compile("1\nb").findall(grep), [((0, 4), (1, 1))])
+        self.assertEqual(gg.compile("1\nb;|;num").findall(grep), [((0, 4), (1, 1)), ((1, 4), (1, 5))])
+        self.assertEqual(gg.compile_set(["1\nb", "2"]).findall(grep), [[((0, 4), (1, 1))], [((1, 4), (1, 5))]])
+
+    def test_non_ascii_label_columns(self):
+        # the ast module counts columns in utf-8 bytes, the labels still end where their text does
+        grep = GrammarGrep('s = "ééé"\nt = 1')
+        for engine in [None, "backtrack", "pike", "unanchored", "compiled", "dfa"]:
+            self.assertEqual(gg.compile(";str;|;num;|;id").findall(grep, engine),
+                             [((0, 0), (0, 1)), ((0, 4), (0, 9)), ((1, 0), (1, 1)), ((1, 4), (1, 5))], engine)
+        self.assertEqual(GrammarGrep('s = "ééé"').match(";str", "unanchored"), [((0, 4), (0, 9))])
+        self.assertFalse(CodeText(["ab"]).is_line_end(5))
+
+
+class TestAhoCorasick(unittest.TestCase):
+
+    def test_find_every_occurrence(self):
+        occurrences = AhoCorasick(["he", "she", "his", "hers", "x"]).find_all("ushers\n\nhis hershe")
+        self.assertEqual(occurrences, [[2, 12, 16], [1, 15], [8], [2, 12], []])
+
+    def test_no_words(self):
+        self.assertEqual(AhoCorasick([]).find_all("abc"), [])
+
+
+class TestPatternCache(unittest.TestCase):
+
+    def test_cache_hit_returns_same_automata(self):
+        cache = PatternCache(4)
+        nfa = cache.get(";id + 5")
+        self.assertIs(cache.get(";id + 5"), nfa)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = PatternCache(2)
+        cache.get("a")
+        cache.get("b")
+        cache.get("a")
+        cache.get("c")
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_cache_resize(self):
+        cache = PatternCache(3)
+        for regex in ["a", "b", "c"]:
+            cache.get(regex)
+        cache.maxsize = 1
+        self.assertEqual(len(cache), 1)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_cache_keyed_by_dfa_states_max(self):
+        cache = PatternCache(4)
+        nfa = cache.get("a;id", 2)
+        self.assertIs(cache.get("a;id", 2), nfa)
+        self.assertIsNot(cache.get("a;id"), nfa)
+        self.assertEqual(nfa.dfa_states_max, 2)
+        self.assertTrue(cache.contains("a;id", 2))
+        self.assertIn("a;id", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_cache_does_not_store_invalid_regex(self):
+        cache = PatternCache(2)
+        self.assertRaises(RuntimeError, cache.get, ";(;(;x))")
+        self.assertEqual(len(cache), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,8 +13,13 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--match', type=str, required=True, help='regex used for matchin')
     parser.add_argument('-r', '--replace', nargs="*", required=False,
                         help='list of strings, ith group in matched string will be replaced with ith string in list')
+    parser.add_argument('--cache-size', type=int, required=False, default=None,
+                        help='number of compiled regexes kept in the pattern cache')
     args = parser.parse_args()
 
+    if args.cache_size is not None:
+        pattern_cache.maxsize = args.cache_size
+
     f = open(args.filename, "r")
     code = f.read()
 